@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.7/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 PRODUCTION = False
@@ -101,3 +102,74 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 STATIC_ROOT = '/var/www/static/'
+
+# Set to a directory to keep a copy of every OPB model given to the solver
+# (for debugging).  The model is otherwise streamed straight to the solver.
+SOLVER_OPB_DUMP_DIR = None
+
+# Unix socket used to wake up idle solve workers when a run is queued.  It
+# is in the temporary directory so that workers leave nothing in the checkout.
+SOLVER_WAKEUP_SOCKET = os.path.join(tempfile.gettempdir(),
+                                    'solver_wakeup.sock')
+
+# Number of clasp threads per run.  The solve workers share
+# SOLVER_NUM_CORES (None means all of the machine's cores) between the
+# runs in flight, giving each between SOLVER_MIN_THREADS and
+# SOLVER_MAX_THREADS depending on load and model size.
+SOLVER_NUM_CORES = None
+SOLVER_MIN_THREADS = 1
+SOLVER_MAX_THREADS = 8
+
+# Number of clasp processes, each with a different configuration and seed,
+# racing on every run (sharing the run's threads).  The best result wins.
+SOLVER_PORTFOLIO_SIZE = 1
+
+# Problems with at least SOLVER_LNS_MIN_PUPILS pupils are solved by large
+# neighborhood search: starting from a schedule, repeatedly re-solve the
+# lessons of SOLVER_LNS_NEIGHBORHOOD_SIZE pupils (or of one day) with the
+# rest fixed, for at most SOLVER_LNS_SUBPROBLEM_TIME_LIMIT seconds each and
+# SOLVER_LNS_TIME_LIMIT seconds in total.
+SOLVER_LNS_MIN_PUPILS = 150
+SOLVER_LNS_NEIGHBORHOOD_SIZE = 30
+SOLVER_LNS_SUBPROBLEM_TIME_LIMIT = 10
+SOLVER_LNS_TIME_LIMIT = 600
+
+# Split models into independent components (pupils which can never compete
+# for instructor time and share no objective term) solved by separate clasp
+# processes in parallel, whose results are merged.
+SOLVER_DECOMPOSE = True
+
+# Fix the variables the constraints force before the model is given to the
+# solver.
+SOLVER_PRESOLVE = True
+
+# Seconds spent improving the provisional schedule which is saved (without
+# the solver) as soon as a run starts.
+SOLVER_GREEDY_TIME_LIMIT = 0.5
+
+# How the no break penalty is given to the solver.  'chains' uses
+# variables for how long the instructor has been working, linear in the
+# number of slots a day.  'products' makes a product term for every
+# stretch of work, cubic in the number of slots a day.
+SOLVER_NO_BREAK_ENCODING = 'chains'
+
+# How the arrive late, leave early and day off bonuses are given to the
+# solver.  'chains' uses variables for the instructor being free from the
+# start (or until the end) of the day up to each slot, linear in the
+# number of slots a day.  'products' makes a product term for every
+# possible first (or last) busy slot, quadratic in the number of slots.
+SOLVER_DAY_BONUS_ENCODING = 'chains'
+
+# The solver models are given to.  'clasp' runs clasp.  'replay' solves
+# nothing, for load testing the queue and workers: it replays
+# SOLVER_REPLAY_FILE (output recorded from clasp on the same model, so with
+# SOLVER_DECOMPOSE off) or else the output clasp would give for a greedy
+# schedule, waiting SOLVER_REPLAY_INTERVAL seconds before each model.
+SOLVER_BACKEND = 'clasp'
+SOLVER_REPLAY_FILE = None
+SOLVER_REPLAY_INTERVAL = 1.0
+
+# Seconds between saving the best schedule the solver has found so far
+# while it runs (the first one is saved right away), so a good schedule
+# can be taken early.  None only saves the final schedule.
+SOLVER_SCHEDULE_SAVE_INTERVAL = 10
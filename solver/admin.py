@@ -8,4 +8,5 @@ admin.site.index_title = 'Solver Site Administration'
 admin.site.register(Availability)
 admin.site.register(SolverOptions)
 admin.site.register(SolverRun)
+admin.site.register(SolverOutputChunk)
 admin.site.register(Schedule)
@@ -0,0 +1,308 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The solvers which models are given to.
+
+A solver process is started with a model and works on it in the
+background.  The scheduler waits for its output with select (processes
+have a fileno), hands the lines read by the process's reader to
+ProcessLines and finally calls Stop.  The output is in the format of the
+pseudo-Boolean competition, as written by clasp: 'o' lines with the
+objective of each model found, an 's' line with the status, 'v' lines
+with the values of the model and 'c' comment lines.  It is decoded as it
+arrives, only the lines not logged yet are kept.  Solvers may output the
+values of every model they find (clasp prints them before the model's
+'o' line), only those of the last model are logged, with the 's' line or
+at the end of the output.
+"""
+
+import array
+import logging
+import os
+import re
+import select
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# clasp's predefined configurations, used in turn by portfolio members.
+kPortfolioConfigurations = [
+    'auto', 'frumpy', 'jumpy', 'tweety', 'trendy', 'crafty', 'handy']
+
+
+def StreamModel(handle, model, chunk_size=1<<16):
+  """Write the model to a binary handle in chunks.
+
+  Only one chunk of the serialized model is in memory at a time.
+  """
+  chunk = []
+  size = 0
+  for line in model.OpbLines():
+    chunk.append(line)
+    size += len(line)
+    if size >= chunk_size:
+      handle.write(''.join(chunk).encode('ascii'))
+      chunk = []
+      size = 0
+  if chunk:
+    handle.write(''.join(chunk).encode('ascii'))
+
+
+def ClaspOutput(status, objective=None, values=None):
+  """Solver output for a model with the values (indexed by variable)."""
+  lines = []
+  if objective is not None:
+    lines.append('o ' + str(objective))
+  lines.append('s ' + status)
+  if values is not None:
+    x_names = [('x' if values[var] else '-x') + str(var)
+               for var in range(1, len(values))]
+    for index in range(0, len(x_names), 10):
+      lines.append('v ' + ' '.join(x_names[index:index + 10]))
+  if objective is not None:
+    lines.append('c Optimization : ' + str(objective))
+  return '\n'.join(lines) + '\n'
+
+
+class LineReader:
+  """Read a pipe in chunks and split it into lines as they complete."""
+
+  def __init__(self, handle, chunk_size=1<<16):
+    self.fd = handle.fileno()
+    self.chunk_size = chunk_size
+    self.partial_line = ''
+    self.eof = False
+
+  def fileno(self):
+    return self.fd
+
+  def Read(self, timeout):
+    """Wait at most timeout seconds for output.
+
+    Returns (chunk, lines) where chunk is all the text read and lines are
+    the lines (without newline) completed by it.
+    """
+    (ready, unused_write, unused_error) = select.select(
+        [self.fd], [], [], timeout)
+    if not ready:
+      return ('', [])
+    return self.ReadReady()
+
+  def ReadReady(self):
+    """Read once select has reported that there is output (or EOF)."""
+    chunk = os.read(self.fd, self.chunk_size).decode('ascii')
+    if not chunk:
+      self.eof = True
+      if self.partial_line:
+        lines = [self.partial_line]
+        self.partial_line = ''
+        return ('', lines)
+      return ('', [])
+    lines = (self.partial_line + chunk).split('\n')
+    self.partial_line = lines.pop()
+    return (chunk, lines)
+
+
+class SolverProcess:
+  """A solver working on a model, one member of a portfolio.
+
+  Subclasses start the solver in their constructor, set reader to a
+  LineReader of its output and implement Stop.
+  """
+
+  def __init__(self, name, model):
+    self.name = name
+    self.num_variables = model.num_variables
+    # Without an objective the solver stops at the first model.
+    self.optimizing = bool(model.objective)
+    self.args = []  # The command line, if the solver is a program.
+    self.reader = None
+    self.unlogged = []  # Output lines (with newline) not logged yet.
+    # The 'v' lines of the last model, logged with the 's' line.
+    self.model_lines = []
+    self.objective = None  # From the last 'o' line.
+    if not self.optimizing:
+      self.objective = 0
+    self.status = None  # From the 's' line.
+    # The values of the last complete model, indexed by variable number.
+    self.values = None
+    self.num_models = 0
+    # Filled in by the 'v' lines of the model being read.
+    self.next_values = array.array('b', [0]) * (self.num_variables + 1)
+    self.reading_model = False
+
+  def fileno(self):
+    return self.reader.fileno()
+
+  def ProcessLines(self, lines):
+    """Decode output lines, returns True if the objective improved."""
+    improved = False
+    for line in lines:
+      kind = line[:2]
+      if kind != 'v ' and self.reading_model:
+        self.EndModel()
+      if kind == 'v ' and self.status is None:
+        if not self.reading_model:
+          # A new model, the values of the previous one aren't logged.
+          self.model_lines = []
+        self.model_lines.append(line + '\n')
+      else:
+        if kind == 's ':
+          self.LogModelLines()
+        self.unlogged.append(line + '\n')
+      if kind == 'v ':
+        self.reading_model = True
+        for x in line.split()[1:]:
+          if x[0] == '-':
+            self.next_values[int(x[2:])] = 0
+          elif x[0] == 'x':
+            self.next_values[int(x[1:])] = 1
+      elif kind == 'o ':
+        self.objective = int(line[2:])
+        improved = True
+      elif kind == 's ':
+        self.status = line[2:].strip()
+      elif kind == 'c ':
+        m = re.match(r'^c\s+optimization\s*:\s*(-?\d+)\s*$',
+                     line.strip().lower())
+        if m:
+          self.objective = int(m.group(1))
+    if self.reader is not None and self.reader.eof:
+      self.LogModelLines()
+    return improved
+
+  def LogModelLines(self):
+    self.unlogged.extend(self.model_lines)
+    self.model_lines = []
+
+  def EndModel(self):
+    """The 'v' lines of a model are complete."""
+    self.values = array.array('b', self.next_values)
+    self.num_models += 1
+    self.reading_model = False
+
+  def LastModel(self):
+    """The values of the last model output so far, or None."""
+    if self.reading_model and (self.reader is None or self.reader.eof):
+      self.EndModel()
+    return self.values
+
+  def HasUnloggedOutput(self):
+    return bool(self.unlogged)
+
+  def UnloggedLines(self):
+    lines = self.unlogged
+    self.unlogged = []
+    return lines
+
+  def Finished(self):
+    """Whether this process has proven its result."""
+    if not self.optimizing and self.status == 'SATISFIABLE':
+      return True
+    return self.status in ['OPTIMUM FOUND', 'UNSATISFIABLE']
+
+  def Assignment(self):
+    """The values of the variables in the model output, or None."""
+    if self.status not in ['SATISFIABLE', 'OPTIMUM FOUND']:
+      return None
+    return self.LastModel()
+
+  def ReadRemainingOutput(self):
+    while not self.reader.eof:
+      (unused_chunk, lines) = self.reader.Read(None)
+      self.ProcessLines(lines)
+
+  def Stop(self):
+    """Cancel the search, the output then ends with the best model."""
+    raise NotImplementedError
+
+
+class ClaspProcess(SolverProcess):
+  """A clasp process, the model is streamed to its stdin."""
+
+  def __init__(self, name, model, threads, time_limit, configuration=None,
+               seed=None, all_models=False):
+    SolverProcess.__init__(self, name, model)
+    self.args = ['clasp', '-t' + str(threads),
+                 '--time-limit=' + str(time_limit)]
+    if configuration:
+      self.args.append('--configuration=' + configuration)
+    if seed is not None:
+      self.args.append('--seed=' + str(seed))
+    if all_models:
+      # Output the values of every model, not just of the final one.
+      self.args.append('--quiet=0')
+    # Without a file argument clasp reads the model from stdin.
+    self.process = subprocess.Popen(
+        self.args, bufsize=0,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+    self.reader = LineReader(self.process.stdout)
+    try:
+      StreamModel(self.process.stdin, model)
+    except BrokenPipeError:
+      # clasp exited early, its output says why.
+      logger.error('clasp closed its input before reading the whole model.')
+    self.process.stdin.close()
+
+  def Stop(self):
+    """Terminate clasp (it then prints its best model) and read the rest.
+
+    A process which has proven its result is still printing its model and
+    is left to exit by itself.
+    """
+    if self.process.poll() == None and not self.Finished():
+      self.process.terminate()
+    self.ReadRemainingOutput()
+    self.process.stderr.read()
+    self.process.wait()
+
+
+class ReplayProcess(SolverProcess):
+  """Replays solver output instead of solving, for testing without clasp.
+
+  The output (recorded from a solver, or made with ClaspOutput) is written
+  to a pipe by a thread, which waits interval seconds before each 'o' and
+  's' line as if the models took that long to find.  Stop writes the rest
+  without waiting.
+  """
+
+  def __init__(self, name, model, output, interval):
+    SolverProcess.__init__(self, name, model)
+    (read_fd, write_fd) = os.pipe()
+    self.handle = os.fdopen(read_fd, 'rb', 0)
+    self.reader = LineReader(self.handle)
+    self.stopping = threading.Event()
+    self.thread = threading.Thread(
+        target=self.Replay, args=(write_fd, output, interval))
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Replay(self, write_fd, output, interval):
+    with os.fdopen(write_fd, 'wb', 0) as handle:
+      for line in output.splitlines(True):
+        if line.startswith('o ') or line.startswith('s '):
+          self.stopping.wait(interval)
+        handle.write(line.encode('ascii'))
+
+  def Stop(self):
+    self.stopping.set()
+    self.ReadRemainingOutput()
+    self.thread.join()
+    self.handle.close()
@@ -0,0 +1,65 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Share the machine's cores between the clasp runs of all solve workers."""
+
+import multiprocessing
+import os
+
+from scheduler import settings
+
+# Models smaller than this many variables per thread don't get any faster
+# with more threads.
+kVariablesPerThread = 200
+
+
+class ThreadBudget:
+  """Hand out clasp thread counts so that runs in flight fit the cores.
+
+  Create it before forking workers, the count of threads in use lives in
+  shared memory.
+  """
+
+  def __init__(self, num_cores=None, min_threads=None, max_threads=None):
+    self.num_cores = (num_cores or settings.SOLVER_NUM_CORES or
+                      os.cpu_count() or 1)
+    self.min_threads = min_threads or settings.SOLVER_MIN_THREADS
+    self.max_threads = max_threads or settings.SOLVER_MAX_THREADS
+    assert 1 <= self.min_threads <= self.max_threads, (
+        'Thread limits must satisfy 1 <= min <= max.')
+    self.lock = multiprocessing.Lock()
+    self.threads_in_use = multiprocessing.Value('i', 0, lock=False)
+
+  def ThreadsWanted(self, num_variables):
+    """The number of threads a model of this size can make use of."""
+    return max(1, min(self.max_threads,
+                      num_variables // kVariablesPerThread))
+
+  def Acquire(self, num_variables):
+    """Reserve threads for a run, at least min_threads even if busy."""
+    with self.lock:
+      free = self.num_cores - self.threads_in_use.value
+      threads = max(self.min_threads,
+                    min(self.ThreadsWanted(num_variables), free))
+      self.threads_in_use.value += threads
+      return threads
+
+  def Release(self, threads):
+    with self.lock:
+      self.threads_in_use.value -= threads
@@ -0,0 +1,315 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Find a reasonable schedule quickly, without the solver."""
+
+import time
+
+from solver import pbmodel
+
+
+class GreedyScheduler:
+  """Greedy construction followed by local improvement.
+
+  Works on a prepared Scheduler.  Pupils with the fewest possible start
+  slots per lesson are placed first, each lesson where it costs the least
+  preference penalty, preferring days and times next to lessons already
+  placed.  Then lessons are moved and pairs of lessons swapped while that
+  improves the objective, until the time limit.
+  """
+
+  def __init__(self, scheduler, time_limit):
+    self.spec = scheduler.spec
+    self.model = scheduler.model
+    self.var_id = scheduler.var_id
+    self.time_limit = time_limit
+    self.pupil_preference_penalty = scheduler.pupil_preference_penalty
+    self.instructor_preference_penalty = (
+        scheduler.instructor_preference_penalty)
+    self.values = [False] * (self.model.num_variables + 1)
+    self.occupant = [None] * self.spec.num_slots  # Pupil using each slot.
+    self.lessons = dict()  # Pupil to the start slots of their lessons.
+    # Variable to the indices of the objective terms and of the >=
+    # constraints using it.  Everything else holds by construction.
+    self.var_terms = [[] for _ in range(self.model.num_variables + 1)]
+    for index, term in enumerate(self.model.objective):
+      for literal in term.literals:
+        self.var_terms[abs(literal)].append(index)
+    self.var_constraints = [[] for _ in range(self.model.num_variables + 1)]
+    for index, constraint in enumerate(self.model.constraints):
+      if constraint.relation == '>=':
+        for term in constraint.terms:
+          for literal in term.literals:
+            self.var_constraints[abs(literal)].append(index)
+    # Variable to the indices of the model's definitions using it.
+    self.var_definitions = [[] for _ in range(self.model.num_variables + 1)]
+    for index, (unused_var, literals) in enumerate(self.model.definitions):
+      for literal in literals:
+        self.var_definitions[abs(literal)].append(index)
+    # (pupil, slot) to what a lesson there affects, see Affected.
+    self.affected = dict()
+    for (pupil, slot) in scheduler.FixedLessons():
+      self.Place(pupil, slot)
+    pbmodel.SetDefinedVariables(self.model, self.values)
+    self.options = dict()  # Pupil to the start slots they could use.
+    for pupil in range(1, self.spec.num_pupils):
+      if pupil not in self.lessons:
+        self.options[pupil] = [slot for slot in range(self.spec.num_slots)
+                               if self.var_id[pupil][slot] >= 0]
+
+  def Variables(self, pupil, slot):
+    """The variables which are true if pupil has a lesson in slot."""
+    variables = [self.var_id[pupil][slot]]
+    for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+      variables.append(self.var_id[0][occlud])
+    return [var for var in variables if var >= 0]
+
+  def Affected(self, pupil, slot):
+    """What a lesson of pupil in slot changes.
+
+    Returns the indices of the definitions (in order), of the objective
+    terms and of the constraints whose value may change.
+    """
+    if (pupil, slot) not in self.affected:
+      variables = set(self.Variables(pupil, slot))
+      definitions = set()
+      stack = list(variables)
+      while stack:
+        for index in self.var_definitions[stack.pop()]:
+          if index not in definitions:
+            definitions.add(index)
+            var = self.model.definitions[index][0]
+            variables.add(var)
+            stack.append(var)
+      terms = set()
+      constraints = set()
+      for var in variables:
+        terms.update(self.var_terms[var])
+        constraints.update(self.var_constraints[var])
+      self.affected[(pupil, slot)] = (sorted(definitions), terms, constraints)
+    return self.affected[(pupil, slot)]
+
+  def Define(self, definitions):
+    """Update the variables of the definitions at these indices."""
+    for index in definitions:
+      (var, literals) = self.model.definitions[index]
+      self.values[var] = all(
+          [pbmodel.LiteralValue(literal, self.values)
+           for literal in literals])
+
+  def CanPlace(self, pupil, slot):
+    if self.var_id[pupil][slot] < 0:
+      return False
+    for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+      if self.occupant[occlud] is not None:
+        return False
+    day = self.spec.slot_time[slot].day
+    for other in self.lessons.get(pupil, []):
+      if self.spec.slot_time[other].day == day:
+        return False
+    return True
+
+  def Place(self, pupil, slot):
+    for var in self.Variables(pupil, slot):
+      self.values[var] = True
+    for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+      self.occupant[occlud] = pupil
+    self.lessons.setdefault(pupil, []).append(slot)
+
+  def Unplace(self, pupil, slot):
+    for var in self.Variables(pupil, slot):
+      self.values[var] = False
+    for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+      self.occupant[occlud] = None
+    self.lessons[pupil].remove(slot)
+
+  def Change(self, removals, additions):
+    """Replace the lessons removals by additions.
+
+    Returns the change of the objective, or None (leaving everything as
+    it was) if the additions don't fit.
+    """
+    definitions = set()
+    terms = set()
+    constraints = set()
+    for (pupil, slot) in removals + additions:
+      affected = self.Affected(pupil, slot)
+      definitions.update(affected[0])
+      terms.update(affected[1])
+      constraints.update(affected[2])
+    definitions = sorted(definitions)
+    before = self.TermsValue(terms)
+    for (pupil, slot) in removals:
+      self.Unplace(pupil, slot)
+    placed = []
+    for (pupil, slot) in additions:
+      if not self.CanPlace(pupil, slot):
+        break
+      self.Place(pupil, slot)
+      placed.append((pupil, slot))
+    self.Define(definitions)
+    if len(placed) == len(additions) and all(
+        [pbmodel.ConstraintSatisfied(self.model.constraints[index],
+                                     self.values)
+         for index in constraints]):
+      return self.TermsValue(terms) - before
+    for (pupil, slot) in reversed(placed):
+      self.Unplace(pupil, slot)
+    for (pupil, slot) in removals:
+      self.Place(pupil, slot)
+    self.Define(definitions)
+    return None
+
+  def TermsValue(self, indices):
+    return pbmodel.EvaluateTerms(
+        [self.model.objective[index] for index in indices], self.values)
+
+  def PlacementCost(self, pupil, slot):
+    """A cheap estimate of what a lesson in slot adds to the objective.
+
+    Returns a tuple: whether the lesson takes the instructor in on a new
+    day, the preference penalties and how many of the lesson's ends don't
+    touch another lesson.
+    """
+    cost = 0
+    preference = self.spec.pupil_slot_preference[pupil][slot]
+    if preference > 1:
+      cost += (self.pupil_preference_penalty[preference-2] *
+               self.spec.pupil_lesson_length[pupil])
+    for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+      preference = self.spec.pupil_slot_preference[0][occlud]
+      if preference > 1:
+        cost += (self.instructor_preference_penalty[preference-2] *
+                 self.spec.slot_time[occlud].length)
+    # Keep the instructor's days few and without gaps.
+    day_slots = self.spec.slots_by_day[self.spec.slot_time[slot].day]
+    new_day = all([self.occupant[other] is None for other in day_slots])
+    occluded = self.spec.pupil_slot_occlusion[pupil][slot]
+    loose_ends = 2
+    index = day_slots.index(occluded[0])
+    if index > 0 and self.occupant[day_slots[index-1]] is not None:
+      loose_ends -= 1
+    index = day_slots.index(occluded[-1])
+    if (index < len(day_slots) - 1 and
+        self.occupant[day_slots[index+1]] is not None):
+      loose_ends -= 1
+    return (new_day, cost, loose_ends)
+
+  def Construct(self, deadline):
+    """Place every lesson.
+
+    Returns False if some lesson didn't fit or the deadline passed.
+    """
+    pupils = sorted(self.options, key=lambda pupil: (
+        len(self.options[pupil]) / float(self.spec.pupil_num_lessons[pupil]),
+        pupil))
+    for pupil in pupils:
+      for unused_lesson in range(self.spec.pupil_num_lessons[pupil]):
+        candidates = sorted(
+            [slot for slot in self.options[pupil]
+             if self.CanPlace(pupil, slot)],
+            key=lambda slot: self.PlacementCost(pupil, slot))
+        for slot in candidates:
+          if time.time() >= deadline:
+            return False
+          if self.Change([], [(pupil, slot)]) is not None:
+            break
+        else:
+          if not self.MakeRoom(pupil, deadline):
+            return False
+    return True
+
+  def MakeRoom(self, pupil, deadline):
+    """Place a lesson of pupil by moving one lesson that is in the way.
+
+    Returns False if that isn't possible or the deadline passed.
+    """
+    for slot in self.options[pupil]:
+      if time.time() >= deadline:
+        return False
+      occluded = set(self.spec.pupil_slot_occlusion[pupil][slot])
+      blocking = set([self.occupant[occlud] for occlud in occluded])
+      blocking.discard(None)
+      if len(blocking) != 1:
+        continue
+      other = blocking.pop()
+      if other == pupil or other not in self.options:
+        continue
+      for other_slot in list(self.lessons[other]):
+        if not occluded & set(
+            self.spec.pupil_slot_occlusion[other][other_slot]):
+          continue
+        for new_slot in self.options[other]:
+          if time.time() >= deadline:
+            return False
+          if new_slot == other_slot:
+            continue
+          if self.Change([(other, other_slot)],
+                         [(pupil, slot), (other, new_slot)]) is not None:
+            return True
+    return False
+
+  def Improve(self, deadline):
+    """Move and swap lessons while that improves the objective."""
+    improved = True
+    while improved and time.time() < deadline:
+      improved = False
+      for pupil in sorted(self.options):
+        for slot in list(self.lessons[pupil]):
+          for other_slot in self.options[pupil]:
+            if time.time() >= deadline:
+              return
+            if other_slot == slot:
+              continue
+            other = self.occupant[other_slot]
+            if other is None:
+              delta = self.Change([(pupil, slot)], [(pupil, other_slot)])
+            elif (other in self.options and other != pupil and
+                  other_slot in self.lessons[other] and
+                  slot in self.options[other]):
+              delta = self.Change([(pupil, slot), (other, other_slot)],
+                                  [(pupil, other_slot), (other, slot)])
+            else:
+              continue
+            if delta is None:
+              continue
+            if delta < 0:
+              improved = True
+              break
+            # Not better, undo.
+            if other is None:
+              self.Change([(pupil, other_slot)], [(pupil, slot)])
+            else:
+              self.Change([(pupil, other_slot), (other, slot)],
+                          [(pupil, slot), (other, other_slot)])
+
+  def Run(self):
+    """Returns the values of the model's variables, or None if not found.
+
+    Both placing the lessons and improving the schedule stop at the time
+    limit.
+    """
+    deadline = time.time() + self.time_limit
+    if not self.Construct(deadline):
+      return None
+    self.Improve(deadline)
+    for constraint in self.model.constraints:
+      if not pbmodel.ConstraintSatisfied(constraint, self.values):
+        return None
+    return self.values
@@ -1,48 +1,79 @@
+#!/usr/bin/python3
+"""Write a random availability CSV for testing and benchmarking.
+
+The same arguments (including the seed) always give the same file.  The
+random preferences are drawn per 30 minute period and shared by all of its
+slots, so changing only the slot granularity gives the same problem on a
+finer grid.
+"""
+
+import argparse
 import csv
 import random
+import sys
+
+kPeriodMinutes = 30
+
+
+def TimeString(minutes):
+  return str(minutes // 60) + ':%02d' % (minutes % 60)
+
+
+def MakeSchedule(seed=0, num_pupils=None, slot_minutes=30, days='MTWRF',
+                 day_start=9*60, day_end=17*60, lesson_lengths=(30, 30, 60),
+                 multi_lesson_ratio=0.35):
+  """The rows of a random availability CSV.
+
+  num_pupils defaults to 40% of the number of 30 minute periods.  Each
+  pupil's lesson length is drawn from lesson_lengths and
+  multi_lesson_ratio of the pupils have two or three lessons.
+  """
+  assert kPeriodMinutes % slot_minutes == 0, (
+      'The slot length must divide ' + str(kPeriodMinutes) + ' minutes.')
+  rng = random.Random(seed)
+  periods_per_day = (day_end - day_start) // kPeriodMinutes + 1
+  if num_pupils is None:
+    num_pupils = int(len(days) * periods_per_day * .4)
 
-with open('sched.csv', 'wb') as csvfile:
-  csvwriter = csv.writer(csvfile, delimiter=',',
-                         quotechar='\"', quoting=csv.QUOTE_MINIMAL,
-                         lineterminator='\n')
   slot_times = ['Schedule']
-  i1_available = ['Instructor1']
-  i1_restriction = ['Instructor1 Restrictions']
-  # days = ['M', 'T', 'W', 'R', 'F', 'S', 'U']
-  days = ['M', 'T', 'W', 'R', 'F']
-  for day_index in xrange(len(days)):
-    day = days[day_index]
-    for t in [x*30+9*60 for x in xrange(8*2+1)]:
-      slot_times.append(day + ' ' + str(t/60) + ':%02d' % (t % 60))
-      r = random.random()
-      if r < .9:
+  slot_period = []  # The index of the 30 minute period of each slot.
+  for day_index, day in enumerate(days):
+    for period in range(periods_per_day):
+      for offset in range(0, kPeriodMinutes, slot_minutes):
+        minutes = day_start + period * kPeriodMinutes + offset
+        if minutes > day_end:
+          break
+        slot_times.append(day + ' ' + TimeString(minutes))
+        slot_period.append(day_index * periods_per_day + period)
+
+  instructor_period = []
+  for day in days:
+    for period in range(periods_per_day):
+      r = rng.random()
+      if period == periods_per_day - 1:
+        # The last slot of the day only marks the end of the one before.
+        val = ''
+      elif r < .9:
         val = '1'
       elif r < .95:
         val = '2'
       else:
         val = '3'
-      i1_available.append(val)
-      restriction = ''
-      if t in [x*30+11*60+30 for x in xrange(4)]:
-        restriction = 'L' + day + '_1'
-      if t in [x*30+11*60+30 for x in xrange(1)]:
-        restriction += ',F_0'
-      i1_restriction.append(restriction)
-    i1_available[-1] = ''
-  csvwriter.writerow(slot_times)
-  csvwriter.writerow(i1_available)
-  csvwriter.writerow(i1_restriction)
-  for pupil in xrange(int((len(slot_times)-1)*.4)):
-    pupil_name = 'P'+str(pupil)
-    if (pupil % 3) == 1:
-      pupil_name += ' [60min]'
-    if (pupil % 5) == 1:
-      pupil_name += ' [x3]'
-    elif (pupil % 4) == 1:
-      pupil_name += ' [x2]'
-    pupil_available = [pupil_name]
-    for slot in xrange(len(slot_times)-1):
-      r = random.random()
+      instructor_period.append(val)
+  rows = [slot_times,
+          ['Instructor1'] + [instructor_period[period]
+                             for period in slot_period]]
+
+  for pupil in range(num_pupils):
+    pupil_name = 'P' + str(pupil)
+    length = rng.choice(lesson_lengths)
+    if length != 30:
+      pupil_name += ' [' + str(length) + 'min]'
+    if rng.random() < multi_lesson_ratio:
+      pupil_name += ' [x' + str(rng.choice([2, 2, 3])) + ']'
+    pupil_period = []
+    for unused_period in range(len(instructor_period)):
+      r = rng.random()
       if r < .7:
         val = ''
       elif r < .8:
@@ -51,5 +82,46 @@ with open('sched.csv', 'wb') as csvfile:
         val = '2'
       else:
         val = '3'
-      pupil_available.append(val)
-    csvwriter.writerow(pupil_available)
+      pupil_period.append(val)
+    rows.append([pupil_name] + [pupil_period[period] for period in slot_period])
+  return rows
+
+
+def WriteSchedule(handle, rows):
+  csvwriter = csv.writer(handle, delimiter=',',
+                         quotechar='\"', quoting=csv.QUOTE_MINIMAL,
+                         lineterminator='\n')
+  csvwriter.writerows(rows)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('output', nargs='?', default='sched.csv',
+                      help='The CSV file to write, - for stdout.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--pupils', type=int, default=None,
+                      help='Number of pupils, 40%% of the 30 minute periods '
+                      'by default.')
+  parser.add_argument('--slot-minutes', type=int, default=30,
+                      help='Length of a slot, dividing 30.')
+  parser.add_argument('--days', default='MTWRF',
+                      help='The days of the week, from MTWRFSU.')
+  parser.add_argument('--lesson-lengths', default='30,30,60',
+                      help='Lesson lengths in minutes to draw from.')
+  parser.add_argument('--multi-lesson-ratio', type=float, default=0.35,
+                      help='Fraction of pupils with two or three lessons.')
+  args = parser.parse_args()
+  rows = MakeSchedule(
+      seed=args.seed, num_pupils=args.pupils, slot_minutes=args.slot_minutes,
+      days=args.days,
+      lesson_lengths=[int(x) for x in args.lesson_lengths.split(',')],
+      multi_lesson_ratio=args.multi_lesson_ratio)
+  if args.output == '-':
+    WriteSchedule(sys.stdout, rows)
+  else:
+    with open(args.output, 'w', newline='') as csvfile:
+      WriteSchedule(csvfile, rows)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,162 @@
+import json
+import os
+import subprocess
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from scheduler import settings
+from solver.models import Availability, SolverOptions, SolverRun
+from solver import backend
+from solver import greedy
+from solver import make_test_sched
+from solver import pbmodel
+from solver import solver
+
+kDefaultOptions = {
+    'arrive_late_bonus': 310,
+    'leave_early_bonus': 320,
+    'day_off_bonus': 500,
+    'no_break_penalty': repr({0: 660, 60: 0, 240: 0, 300: 200, 330: 400,
+                              360: 800, 420: 1600, 480: 3200, 540: 6400,
+                              600: 12800, 660: 25600}),
+    'pupil_preference_penalty_list': '100,201,403,807',
+    'instructor_preference_penalty_list': '305,620,1290,2600',
+    'complex_constraints': '30min M 11:30-13:30,30min T 11:30-13:30',
+}
+
+
+class Command(BaseCommand):
+  args = '<output.json>'
+  help = ('time building, writing and reading back the model of generated '
+          'problems, without running clasp')
+  option_list = BaseCommand.option_list + (
+      make_option('--pupils', default='20,40,80',
+                  help='Comma separated pupil counts to sweep.'),
+      make_option('--slot-minutes', default='30,15',
+                  help='Comma separated slot lengths to sweep.'),
+      make_option('--days', default='MTWRF',
+                  help='The days of the week of the problems.'),
+      make_option('--seed', type='int', default=0,
+                  help='Seed of the generated problems.'),
+      make_option('--repeat', type='int', default=3,
+                  help='Report the fastest of this many repetitions.'),
+      make_option('--compare', default=None,
+                  help='An earlier output to compare the times with.'),
+  )
+
+  def handle(self, *args, **options):
+    results = {
+        'version': solver.version_number,
+        'commit': self.Commit(),
+        'cases': [],
+    }
+    for slot_minutes in [int(x) for x in options['slot_minutes'].split(',')]:
+      for num_pupils in [int(x) for x in options['pupils'].split(',')]:
+        case = self.RunCase(num_pupils, slot_minutes, options['days'],
+                            options['seed'], options['repeat'])
+        results['cases'].append(case)
+        self.stdout.write(self.CaseString(case))
+    if options['compare']:
+      with open(options['compare']) as handle:
+        self.Compare(json.load(handle), results)
+    if args:
+      with open(args[0], 'w') as handle:
+        json.dump(results, handle, indent=1, sort_keys=True)
+
+  def Commit(self):
+    """The git commit of the code being timed, if known."""
+    try:
+      return subprocess.check_output(
+          ['git', 'rev-parse', '--short', 'HEAD'],
+          cwd=os.path.dirname(os.path.abspath(__file__)),
+          stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+      return None
+
+  def RunCase(self, num_pupils, slot_minutes, days, seed, repeat):
+    rows = make_test_sched.MakeSchedule(
+        seed=seed, num_pupils=num_pupils, slot_minutes=slot_minutes,
+        days=days)
+    case = {
+        'pupils': num_pupils,
+        'slot_minutes': slot_minutes,
+        'slots': len(rows[0]) - 1,
+        'seconds': dict(),
+    }
+    for unused_repetition in range(repeat):
+      # The schedule saved when parsing the output goes away with the
+      # rest of the run.
+      with transaction.atomic():
+        times = self.TimeCase(rows, case)
+        transaction.set_rollback(True)
+      for phase, seconds in times.items():
+        case['seconds'][phase] = min(
+            case['seconds'].get(phase, seconds), seconds)
+    return case
+
+  def TimeCase(self, rows, case):
+    times = dict()
+    start_time = time.time()
+    constraints = solver.Constraints(default_length=30)
+    constraints.ParseIterator([list(row) for row in rows])
+    times['parse'] = time.time() - start_time
+
+    solver_options = SolverOptions(**kDefaultOptions)
+    solver_options.save()
+    availability = Availability(default_length=30)
+    availability.save()
+    solver_run = SolverRun(options=solver_options, availability=availability,
+                           solver_version=solver.version_number,
+                           state=SolverRun.RUNNING,
+                           solution=SolverRun.NO_SOLUTION)
+    solver_run.save()
+    scheduler = solver.Scheduler(constraints, solver_run)
+    start_time = time.time()
+    scheduler.Prepare()
+    times['prepare'] = time.time() - start_time
+    case['model'] = scheduler.model.Header()
+
+    start_time = time.time()
+    with open(os.devnull, 'wb') as handle:
+      backend.StreamModel(handle, scheduler.model)
+    times['serialize'] = time.time() - start_time
+
+    values = greedy.GreedyScheduler(
+        scheduler, settings.SOLVER_GREEDY_TIME_LIMIT).Run()
+    if values is None:
+      values = [False] * (scheduler.model.num_variables + 1)
+    output = backend.ClaspOutput(
+        'SATISFIABLE',
+        pbmodel.EvaluateTerms(scheduler.model.objective, values), values)
+    start_time = time.time()
+    process = backend.SolverProcess('benchmark', scheduler.model)
+    process.ProcessLines(output.splitlines())
+    scheduler.UseResult(process)
+    scheduler.ParseSolverOutput()
+    times['parse_output'] = time.time() - start_time
+    return times
+
+  def CaseString(self, case):
+    return (str(case['pupils']) + ' pupils, ' + str(case['slots']) +
+            ' slots of ' + str(case['slot_minutes']) + ' min: ' +
+            ', '.join(['%s %.3fs' % (phase, seconds) for phase, seconds in
+                       sorted(case['seconds'].items())]) +
+            '\n  ' + case['model'])
+
+  def Compare(self, old, new):
+    """Print the new times as a fraction of the old ones."""
+    self.stdout.write('Compared with ' + str(old.get('commit')) + ':')
+    old_cases = dict([((case['pupils'], case['slot_minutes']), case)
+                      for case in old['cases']])
+    for case in new['cases']:
+      old_case = old_cases.get((case['pupils'], case['slot_minutes']))
+      if not old_case:
+        continue
+      self.stdout.write(
+          str(case['pupils']) + ' pupils, ' + str(case['slot_minutes']) +
+          ' min: ' + ', '.join(
+              ['%s x%.2f' % (phase, seconds / old_case['seconds'][phase])
+               for phase, seconds in sorted(case['seconds'].items())
+               if old_case['seconds'].get(phase)]))
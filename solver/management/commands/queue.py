@@ -1,15 +1,22 @@
 import os
 import csv
 import time
+from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
 from solver.models import Availability, SolverOptions, SolverRun
 from solver import solver
+from solver import wakeup
 from scheduler import settings
 
 class Command(BaseCommand):
   args = '<availability_id solver_options_id>'
   help = 'solves the given problem'
+  option_list = BaseCommand.option_list + (
+      make_option('--warm-start', action='store_true', default=False,
+                  help='Start from the best schedule found so far for the '
+                  'availability and only look for better ones.'),
+  )
 
   def handle(self, *args, **options):
     availability = Availability.objects.get(pk=int(args[0]))
@@ -22,4 +29,7 @@ class Command(BaseCommand):
     solver_run.score = None
     solver_run.state = SolverRun.IN_QUEUE
     solver_run.solution = SolverRun.NO_SOLUTION
+    if options['warm_start']:
+      solver_run.warm_start = solver.BestSchedule(availability)
     solver_run.save()
+    wakeup.NotifySolverWorkers()
@@ -1,36 +1,62 @@
+import multiprocessing
 import os
 import csv
 import time
+from optparse import make_option
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
 from solver.models import Availability, SolverOptions, SolverRun
+from solver import budget
 from solver import solver
+from solver import wakeup
 from scheduler import settings
 
 class Command(BaseCommand):
   args = '<availability_id solver_options_id solver_run_id>'
   help = 'solves the given problem'
+  option_list = BaseCommand.option_list + (
+      make_option('--workers', type='int', default=1,
+                  help='Number of solver runs to work on in parallel.'),
+  )
 
   def handle(self, *args, **options):
-    first_sleep = True
     if settings.PRODUCTION:
       os.setgid(33)
       os.setuid(33)
+    listener = wakeup.Listener()
+    thread_budget = budget.ThreadBudget()
+    num_workers = options['workers']
+    if num_workers <= 1:
+      self.Worker('', listener, thread_budget)
+      return
+    # Each worker process needs its own database connection.
+    connection.close()
+    workers = []
+    for worker_index in range(num_workers):
+      worker = multiprocessing.Process(
+          target=self.Worker,
+          args=('worker ' + str(worker_index) + ': ', listener,
+                thread_budget))
+      worker.start()
+      workers.append(worker)
+    for worker in workers:
+      worker.join()
+
+  def Worker(self, prefix, listener, thread_budget):
+    first_sleep = True
     while True:
-      all_requests = SolverRun.objects.filter(
-          state=SolverRun.IN_QUEUE).order_by('creation_time')
-      if not all_requests:
+      solver_run = solver.ClaimSolverRun()
+      if not solver_run:
         if first_sleep:
-          print('sleeping')
+          print(prefix + 'sleeping')
           first_sleep = False
-        time.sleep(1)
+        listener.Wait()
         continue
       first_sleep = True
 
-      solver_run = all_requests[0]
-
-      print('Starting run ' + str(solver_run.id) +
+      print(prefix + 'Starting run ' + str(solver_run.id) +
             ' availability ' + str(solver_run.availability.id) +
             ' solver_options ' + str(solver_run.options.id))
      
-      solver.ExecuteSolverRun(solver_run)
+      solver.ExecuteSolverRun(solver_run, thread_budget)
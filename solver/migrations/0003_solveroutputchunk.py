@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0002_availability_default_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SolverOutputChunk',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('offset', models.IntegerField()),
+                ('text', models.TextField()),
+                ('solver_run', models.ForeignKey(to='solver.SolverRun')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
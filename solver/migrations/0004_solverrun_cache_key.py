@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0003_solveroutputchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='solverrun',
+            name='cache_key',
+            field=models.CharField(max_length=64, blank=True, db_index=True, default=''),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0004_solverrun_cache_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='assignment',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='solverrun',
+            name='warm_start',
+            field=models.ForeignKey(blank=True, null=True, related_name='warm_started_runs', to='solver.Schedule'),
+            preserve_default=True,
+        ),
+    ]
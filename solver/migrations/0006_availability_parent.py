@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0005_warm_start'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='availability',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, to='solver.Availability'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0006_availability_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='solverrun',
+            name='phase_times',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='solverrun',
+            name='model_size',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=True,
+        ),
+    ]
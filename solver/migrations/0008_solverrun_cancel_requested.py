@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('solver', '0007_solverrun_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='solverrun',
+            name='cancel_requested',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
@@ -15,6 +15,8 @@ class Availability(models.Model):
   constraints = models.TextField()
   csv_data = models.TextField()
   default_length = models.IntegerField(default=30)
+  # The availability this one was edited from.
+  parent = models.ForeignKey('self', null=True, blank=True)
 
 class SolverOptions(models.Model):
   arrive_late_bonus = models.IntegerField()
@@ -74,12 +76,75 @@ class SolverRun(models.Model):
   )
   solution = models.CharField(max_length=1, choices=SOLUTION_CHOICES)
 
+  # Hash of the parsed availability and options, runs with the same key
+  # solve the same problem.
+  cache_key = models.CharField(max_length=64, blank=True, default='',
+                               db_index=True)
+  # Start the solver from this schedule, only accepting better ones.
+  warm_start = models.ForeignKey('Schedule', null=True, blank=True,
+                                 related_name='warm_started_runs')
+  # repr of a list of (phase, wall seconds, CPU seconds, count), phases
+  # which ran several times add up.  CPU time includes clasp's.
+  phase_times = models.TextField(blank=True, default='')
+  # repr of a dict with the number of variables, constraints and
+  # constraint literals of the first model prepared for the run, and
+  # (objective, terms, literals, products) for each objective.
+  model_size = models.TextField(blank=True, default='')
+  # Set (by the web server) to ask the worker to stop the solver, the best
+  # schedule found so far is the result.
+  cancel_requested = models.BooleanField(default=False)
+
+  def save(self, *args, **kwargs):
+    # The worker holding the run saves it without knowing about a cancel
+    # request made in the meantime, don't overwrite that.
+    if self.pk and not kwargs.get('update_fields'):
+      self.cancel_requested = (
+          self.cancel_requested or SolverRun.objects.filter(
+              pk=self.pk, cancel_requested=True).exists())
+    models.Model.save(self, *args, **kwargs)
+
+  def PhaseTimes(self):
+    if not self.phase_times:
+      return []
+    return ast.literal_eval(self.phase_times)
+
+  def AddPhaseTime(self, name, wall, cpu):
+    phases = self.PhaseTimes()
+    for index, (phase, phase_wall, phase_cpu, count) in enumerate(phases):
+      if phase == name:
+        phases[index] = (phase, round(phase_wall + wall, 6),
+                         round(phase_cpu + cpu, 6), count + 1)
+        break
+    else:
+      phases.append((name, round(wall, 6), round(cpu, 6), 1))
+    self.phase_times = repr(phases)
+
+  def ModelSize(self):
+    if not self.model_size:
+      return None
+    return ast.literal_eval(self.model_size)
+
+  def AllSolverOutput(self):
+    """The solver output, stored as appended chunks (or directly in
+    solver_output for older runs)."""
+    return self.solver_output + ''.join(
+        self.solveroutputchunk_set.order_by('offset').values_list(
+            'text', flat=True))
+
+class SolverOutputChunk(models.Model):
+  """A piece of solver output, appended while the solver is running."""
+  solver_run = models.ForeignKey(SolverRun)
+  offset = models.IntegerField()  # Position of text in the solver output.
+  text = models.TextField()
+
 class Schedule(models.Model):
   creation_time = models.DateTimeField(auto_now_add=True)
   deleted = models.BooleanField(default=False)
   score = models.IntegerField(null=True, blank=True)
   schedule = models.TextField()
   created_by = models.ForeignKey(SolverRun)
+  # repr of a dict from pupil name to the list of their lesson slot names.
+  assignment = models.TextField(blank=True, default='')
 
   def __str__(self):
     return ('Schedule with score ' + str(self.score) +
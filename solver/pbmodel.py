@@ -0,0 +1,403 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In memory pseudo-Boolean model which is serialized to OPB text.
+
+A literal is a non-zero int, v stands for x<v> and -v for ~x<v>.  A term
+is a coefficient times the product of a tuple of literals (sorted by
+variable number).  Text is only produced by the serializer at the end.
+"""
+
+import collections
+
+Term = collections.namedtuple('Term', 'coefficient literals')
+Constraint = collections.namedtuple('Constraint', 'terms relation degree')
+
+
+def LiteralString(literal):
+  if literal < 0:
+    return '~x' + str(-literal)
+  return 'x' + str(literal)
+
+
+def TermString(term):
+  return '%+d ' % term.coefficient + ' '.join(
+      [LiteralString(literal) for literal in term.literals])
+
+
+def ConstraintString(constraint):
+  return (' '.join([TermString(term) for term in constraint.terms]) +
+          ' ' + constraint.relation + ' ' + str(constraint.degree) + ';')
+
+
+class PseudoBooleanModel:
+  def __init__(self):
+    self.num_variables = 0
+    self.objective = []
+    self.constraints = []
+    self.products = dict()  # Literal tuple to number of uses.
+    self.max_product_size = 0
+    # (variable, literals) for the variables made by NewProduct, in the
+    # order they were made.
+    self.definitions = []
+
+  def NewVariable(self):
+    self.num_variables += 1
+    return self.num_variables
+
+  def MakeTerm(self, coefficient, literals):
+    """Make a term, registering it as a product if it has several literals.
+
+    literals must already be sorted by variable number.
+    """
+    literals = tuple(literals)
+    if len(literals) > 1:
+      self.products[literals] = self.products.get(literals, 0) + 1
+      self.max_product_size = max(self.max_product_size, len(literals))
+    return Term(coefficient, literals)
+
+  def NewProduct(self, literals):
+    """A new variable which the constraints make the product of literals.
+
+    Unlike a product term, it can be used in other products, which keeps
+    those short.
+    """
+    var = self.NewVariable()
+    for literal in literals:
+      self.AddConstraint([Term(1, (literal,)), Term(-1, (var,))], '>=', 0)
+    self.AddConstraint(
+        [Term(1, (var,))] + [Term(-1, (literal,)) for literal in literals],
+        '>=', 1 - len(literals))
+    self.definitions.append((var, tuple(literals)))
+    return var
+
+  def AddConstraint(self, terms, relation, degree):
+    assert relation in ['>=', '='], 'Unsupported relation ' + relation
+    self.constraints.append(Constraint(terms, relation, degree))
+
+  def Header(self):
+    return ('* #variable= ' + str(self.num_variables) +
+            ' #constraint= ' + str(len(self.constraints)) +
+            ' #product= ' + str(len(self.products)) +
+            ' sizeproduct= ' + str(self.max_product_size))
+
+  def OpbLines(self):
+    """Generate the OPB file line by line."""
+    yield self.Header() + '\n'
+    if self.objective:
+      yield 'min: ' + ' '.join(
+          [TermString(term) for term in self.objective]) + ';\n'
+    for constraint in self.constraints:
+      yield ConstraintString(constraint) + '\n'
+
+  def Components(self):
+    """Split the variables into independent sets.
+
+    Two variables are in the same component if they are linked by a chain
+    of constraints and objective terms.  Returns a list of sorted lists of
+    variables.
+    """
+    parent = list(range(self.num_variables + 1))
+
+    def Find(var):
+      while parent[var] != var:
+        parent[var] = parent[parent[var]]
+        var = parent[var]
+      return var
+
+    literal_lists = [term.literals for term in self.objective]
+    for constraint in self.constraints:
+      literal_lists.append(
+          [literal for term in constraint.terms for literal in term.literals])
+    for literals in literal_lists:
+      root = Find(abs(literals[0]))
+      for literal in literals[1:]:
+        other = Find(abs(literal))
+        if other != root:
+          parent[other] = root
+    components = dict()
+    for var in range(1, self.num_variables + 1):
+      components.setdefault(Find(var), []).append(var)
+    return sorted(components.values())
+
+  def Submodel(self, variables):
+    """The part of the model using variables, a union of components.
+
+    Returns (model, number) where number maps variables to the variables
+    of the new model.
+    """
+    model = PseudoBooleanModel()
+    number = dict()
+    for var in variables:
+      number[var] = model.NewVariable()
+
+    def Renumber(literals):
+      return sorted([number[literal] if literal > 0 else -number[-literal]
+                     for literal in literals], key=abs)
+
+    for term in self.objective:
+      if abs(term.literals[0]) in number:
+        model.objective.append(
+            model.MakeTerm(term.coefficient, Renumber(term.literals)))
+    for constraint in self.constraints:
+      if abs(constraint.terms[0].literals[0]) in number:
+        model.AddConstraint(
+            [model.MakeTerm(term.coefficient, Renumber(term.literals))
+             for term in constraint.terms],
+            constraint.relation, constraint.degree)
+    for var, literals in self.definitions:
+      if var in number:
+        model.definitions.append((number[var], tuple(Renumber(literals))))
+    return (model, number)
+
+
+def LiteralValue(literal, assignment):
+  """The value of literal given a list of bools indexed by variable."""
+  if literal < 0:
+    return not assignment[-literal]
+  return assignment[literal]
+
+
+def ConstraintSatisfied(constraint, assignment):
+  total = EvaluateTerms(constraint.terms, assignment)
+  if constraint.relation == '=':
+    return total == constraint.degree
+  return total >= constraint.degree
+
+
+def SetDefinedVariables(model, assignment):
+  """Give the variables made by NewProduct their value in assignment."""
+  for var, literals in model.definitions:
+    assignment[var] = all(
+        [LiteralValue(literal, assignment) for literal in literals])
+
+
+def EvaluateTerms(terms, assignment):
+  total = 0
+  for term in terms:
+    for literal in term.literals:
+      if not LiteralValue(literal, assignment):
+        break
+    else:
+      total += term.coefficient
+  return total
+
+
+class Presolver:
+  """Simplify a model before it is given to the solver.
+
+  Constraints are propagated to fix the variables they force, and a
+  constraint x - y = 0 replaces x by y everywhere.  The simplified model
+  only has the remaining variables, renumbered in order.
+  """
+
+  def __init__(self, model):
+    self.model = model
+    self.value = dict()  # Fixed variable to bool.
+    self.alias = dict()  # Replaced variable to the variable replacing it.
+    self.number = dict()  # Remaining variable to its number in new_model.
+    self.new_model = None
+
+  def Representative(self, var):
+    while var in self.alias:
+      var = self.alias[var]
+    return var
+
+  def Value(self, var):
+    """The value of var if it is fixed, else None."""
+    return self.value.get(self.Representative(var))
+
+  def ResolveLiterals(self, literals):
+    """Returns (value, literals) for the product of literals.
+
+    value is the value of the product if it is known, else None and
+    literals are the remaining literals after substitution, sorted.
+    """
+    remaining = set()
+    for literal in literals:
+      var = self.Representative(abs(literal))
+      value = self.value.get(var)
+      if value is not None:
+        if value != (literal > 0):
+          return (False, None)
+        continue
+      if literal < 0:
+        var = -var
+      if -var in remaining:
+        return (False, None)
+      remaining.add(var)
+    if not remaining:
+      return (True, None)
+    return (None, sorted(remaining, key=abs))
+
+  def Fix(self, literal):
+    """Make literal true, returns False if it already is false."""
+    var = self.Representative(abs(literal))
+    value = self.value.get(var)
+    if value is not None:
+      return value == (literal > 0)
+    self.value[var] = literal > 0
+    return True
+
+  def Propagate(self, terms, degree, changed):
+    """Fix what terms >= degree forces.
+
+    Adds the fixed variables to changed, returns False if the constraint
+    can't be satisfied.
+    """
+    total = 0
+    unknown = []
+    for term in terms:
+      (value, literals) = self.ResolveLiterals(term.literals)
+      if value is None:
+        unknown.append((term.coefficient, literals))
+        total += max(0, term.coefficient)
+      elif value:
+        total += term.coefficient
+    slack = total - degree
+    if slack < 0:
+      return False
+    for coefficient, literals in unknown:
+      if coefficient > slack:
+        # The term has to be true.
+        for literal in literals:
+          if not self.Fix(literal):
+            return False
+          changed.add(abs(literal))
+      elif -coefficient > slack and len(literals) == 1:
+        # The term has to be false.
+        if not self.Fix(-literals[0]):
+          return False
+        changed.add(abs(literals[0]))
+    return True
+
+  def Run(self):
+    """Propagate and substitute until nothing changes.
+
+    Returns False if the model turned out to be impossible.
+    """
+    occurrences = dict()
+    for index, constraint in enumerate(self.model.constraints):
+      for term in constraint.terms:
+        for literal in term.literals:
+          occurrences.setdefault(abs(literal), set()).add(index)
+    queue = set(range(len(self.model.constraints)))
+    while queue:
+      while queue:
+        constraint = self.model.constraints[queue.pop()]
+        changed = set()
+        if not self.Propagate(
+            constraint.terms, constraint.degree, changed):
+          return False
+        if constraint.relation == '=' and not self.Propagate(
+            [Term(-term.coefficient, term.literals)
+             for term in constraint.terms], -constraint.degree, changed):
+          return False
+        for var in changed:
+          queue.update(occurrences.get(var, []))
+      for index, constraint in enumerate(self.model.constraints):
+        pair = self.Equivalence(constraint)
+        if pair:
+          (replaced, var) = pair
+          self.alias[replaced] = var
+          # Let the constraints of both variables see the substitution.
+          occurrences.setdefault(var, set()).update(
+              occurrences.get(replaced, []))
+          queue.update(occurrences[var])
+    return True
+
+  def Equivalence(self, constraint):
+    """Returns (x, y) if constraint currently reads x - y = 0, else None."""
+    if constraint.relation != '=' or constraint.degree != 0:
+      return None
+    terms = []
+    for term in constraint.terms:
+      (value, literals) = self.ResolveLiterals(term.literals)
+      if value:
+        return None
+      if value is None:
+        terms.append((term.coefficient, literals))
+    if len(terms) != 2:
+      return None
+    ((coefficient1, literals1), (coefficient2, literals2)) = terms
+    if (coefficient1 != 1 or coefficient2 != -1 or
+        len(literals1) != 1 or len(literals2) != 1 or
+        literals1[0] < 0 or literals2[0] < 0 or literals1 == literals2):
+      return None
+    return (literals1[0], literals2[0])
+
+  def SimplifyTerms(self, terms):
+    """Returns (terms, constant) in the numbering of new_model.
+
+    Terms with the same product are merged and the value of the terms
+    which are known goes into constant.
+    """
+    coefficients = collections.OrderedDict()
+    constant = 0
+    for term in terms:
+      (value, literals) = self.ResolveLiterals(term.literals)
+      if value is None:
+        literals = self.Renumber(literals)
+        coefficients[literals] = (
+            coefficients.get(literals, 0) + term.coefficient)
+      elif value:
+        constant += term.coefficient
+    return ([self.new_model.MakeTerm(coefficient, literals)
+             for literals, coefficient in coefficients.items()
+             if coefficient], constant)
+
+  def Renumber(self, literals):
+    """The remaining literals in the numbering of new_model."""
+    return tuple(sorted(
+        [self.number[literal] if literal > 0 else -self.number[-literal]
+         for literal in literals], key=abs))
+
+  def MakeModel(self):
+    """Make new_model with the remaining variables and constraints.
+
+    The objective is left for the caller to add with SimplifyTerms.
+    """
+    self.new_model = PseudoBooleanModel()
+    for var in range(1, self.model.num_variables + 1):
+      if var not in self.alias and var not in self.value:
+        self.number[var] = self.new_model.NewVariable()
+    for constraint in self.model.constraints:
+      (terms, constant) = self.SimplifyTerms(constraint.terms)
+      degree = constraint.degree - constant
+      if not terms:
+        continue
+      if (constraint.relation == '>=' and
+          sum([min(0, term.coefficient) for term in terms]) >= degree):
+        # Always satisfied.
+        continue
+      self.new_model.AddConstraint(terms, constraint.relation, degree)
+    for var, literals in self.model.definitions:
+      if var in self.number:
+        (value, literals) = self.ResolveLiterals(literals)
+        if value is None:
+          self.new_model.definitions.append(
+              (self.number[var], self.Renumber(literals)))
+    return self.new_model
+
+
+def NumLiterals(model):
+  """The number of literals in the terms of the model."""
+  return (sum([len(term.literals) for term in model.objective]) +
+          sum([len(term.literals) for constraint in model.constraints
+               for term in constraint.terms]))
@@ -0,0 +1,131 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Quick check that there are enough slots for all the lessons.
+
+Every lesson needs a start slot of its own (two lessons starting in the
+same slot would overlap) and a pupil with several lessons needs them on
+different days.  If the lessons can't be matched to start slots like that
+no schedule exists, and the pupils competing for too few slots (a Hall
+violator of the matching) explain why.
+"""
+
+
+class FlowNetwork:
+  """Integer maximum flow by augmenting paths."""
+
+  def __init__(self):
+    self.edges = []  # Node to list of [node, capacity, reverse edge index].
+
+  def AddNode(self):
+    self.edges.append([])
+    return len(self.edges) - 1
+
+  def AddEdge(self, node, other, capacity):
+    self.edges[node].append([other, capacity, len(self.edges[other])])
+    self.edges[other].append([node, 0, len(self.edges[node]) - 1])
+
+  def Augment(self, source, sink):
+    """Push one unit of flow along a path from source to sink if possible."""
+    parent = {source: None}
+    stack = [source]
+    while stack:
+      node = stack.pop()
+      if node == sink:
+        break
+      for index, edge in enumerate(self.edges[node]):
+        if edge[1] > 0 and edge[0] not in parent:
+          parent[edge[0]] = (node, index)
+          stack.append(edge[0])
+    if sink not in parent:
+      return False
+    node = sink
+    while parent[node]:
+      (previous, index) = parent[node]
+      edge = self.edges[previous][index]
+      edge[1] -= 1
+      self.edges[node][edge[2]][1] += 1
+      node = previous
+    return True
+
+  def MaxFlow(self, source, sink):
+    flow = 0
+    while self.Augment(source, sink):
+      flow += 1
+    return flow
+
+  def Reachable(self, source):
+    """The nodes reachable from source in the residual network."""
+    reached = set([source])
+    stack = [source]
+    while stack:
+      node = stack.pop()
+      for edge in self.edges[node]:
+        if edge[1] > 0 and edge[0] not in reached:
+          reached.add(edge[0])
+          stack.append(edge[0])
+    return reached
+
+
+def FindHallViolator(num_lessons, start_slots, slot_day):
+  """Match lessons to distinct start slots, one lesson a day per pupil.
+
+  num_lessons maps each pupil to its number of lessons, start_slots each
+  pupil to the slots a lesson of theirs could start in and slot_day each
+  slot to its day.  Returns None if every lesson can be matched, otherwise
+  (pupils, needed, possible, slots): pupils who need needed lessons
+  between them of which at most possible fit in slots, the slots they can
+  start in.
+  """
+  network = FlowNetwork()
+  source = network.AddNode()
+  sink = network.AddNode()
+  slot_node = dict()
+  for slot in sorted(slot_day):
+    slot_node[slot] = network.AddNode()
+    network.AddEdge(slot_node[slot], sink, 1)
+  pupil_node = dict()
+  for pupil in sorted(num_lessons):
+    pupil_node[pupil] = network.AddNode()
+    network.AddEdge(source, pupil_node[pupil], num_lessons[pupil])
+    if num_lessons[pupil] == 1:
+      for slot in start_slots[pupil]:
+        network.AddEdge(pupil_node[pupil], slot_node[slot], 1)
+      continue
+    day_node = dict()
+    for slot in start_slots[pupil]:
+      day = slot_day[slot]
+      if day not in day_node:
+        day_node[day] = network.AddNode()
+        network.AddEdge(pupil_node[pupil], day_node[day], 1)
+      network.AddEdge(day_node[day], slot_node[slot], 1)
+
+  flow = network.MaxFlow(source, sink)
+  if flow == sum(num_lessons.values()):
+    return None
+  # The pupils still short of lessons and everyone they could displace.
+  reached = network.Reachable(source)
+  pupils = [pupil for pupil in sorted(num_lessons)
+            if pupil_node[pupil] in reached]
+  slots = sorted(set([slot for pupil in pupils
+                      for slot in start_slots[pupil]]))
+  needed = sum([num_lessons[pupil] for pupil in pupils])
+  # What is left on the source's edges are the missing lessons.
+  possible = needed - sum([edge[1] for edge in network.edges[source]])
+  return (pupils, needed, possible, slots)
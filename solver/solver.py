@@ -18,32 +18,35 @@
 # You should have received a copy of the GNU General Public License
 # along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
 
+import array
 import ast
+import bisect
 import collections
+import contextlib
 import csv
+import hashlib
+import itertools
 import logging
 import os
+import random
 import re
 import select
-import subprocess
 import sys
-import tempfile
 import time
 import traceback
 
 from solver.models import *
+from solver import backend
+from solver import greedy
+from solver import pbmodel
+from solver import precheck
+from scheduler import settings
 
 version_number = 'v0.6'
 
 logger = logging.getLogger(__name__)
 SlotTimeSpec = collections.namedtuple('SlotTimeSpec', 'day time length')
 
-def ValFromXVar(var_str):
-  m = re.match(r'^\s*~?x(\d+)\s*$', var_str)
-  assert m
-  return int(m.group(1))
-
-
 kTimeStringReString = r'\d+\s*:\s*\d+\s*(?:am|pm)?'
 kTimeStringReCapture = r'(\d+)\s*:\s*(\d+)\s*(am|pm)?'
 
@@ -57,6 +60,88 @@ def TimeStringToMinInDay(string):
   return minutes
 
 
+def CpuTime():
+  """CPU seconds used by this process and its waited for children."""
+  times = os.times()
+  return times[0] + times[1] + times[2] + times[3]
+
+
+def CancelRequested(solver_run):
+  """Whether the user asked to stop solver_run (read from the database)."""
+  if not solver_run.cancel_requested and solver_run.pk:
+    solver_run.cancel_requested = SolverRun.objects.filter(
+        pk=solver_run.pk, cancel_requested=True).exists()
+  return solver_run.cancel_requested
+
+
+@contextlib.contextmanager
+def TimePhase(solver_run, name):
+  """Add the wall and CPU time spent in the block to solver_run."""
+  start_time = time.time()
+  start_cpu = CpuTime()
+  try:
+    yield
+  finally:
+    solver_run.AddPhaseTime(name, time.time() - start_time,
+                            CpuTime() - start_cpu)
+
+
+class SlotOcclusion:
+  """The slots filled by a lesson of one length, for each start slot.
+
+  Both directions are kept as compressed rows of slot numbers: a lesson
+  starting in slot fills slots[start[slot]:start[slot+1]], which is
+  empty if the lesson doesn't fit before the end of the day, and slot is
+  filled by a lesson starting in any of
+  starts[inverse[slot]:inverse[slot+1]].  Pupils with lessons of the
+  same length share one of these.
+  """
+
+  def __init__(self, length, num_slots, slot_time, slots_by_day):
+    self.length = length
+    self.unfit_slots = []  # Start slots where the lesson doesn't fit.
+    filled = [()] * num_slots
+    for day_slots in slots_by_day:
+      assert all([slot_time[slot].length for slot in day_slots])
+      # cumulative[i] is the minute, counted from the start of the day,
+      # at which the day's i-th slot starts.
+      cumulative = [0] + list(itertools.accumulate(
+          [slot_time[slot].length for slot in day_slots]))
+      for index, slot in enumerate(day_slots):
+        end = bisect.bisect_left(cumulative, cumulative[index] + length)
+        if end < len(cumulative):
+          filled[slot] = day_slots[index:end]
+        else:
+          self.unfit_slots.append(slot)
+    self.start = array.array('i', [0])
+    self.slots = array.array('i')
+    fill_count = [0] * num_slots
+    for slot in range(num_slots):
+      self.slots.extend(filled[slot])
+      self.start.append(len(self.slots))
+      for occlud in filled[slot]:
+        fill_count[occlud] += 1
+    self.inverse = array.array(
+        'i', [0] + list(itertools.accumulate(fill_count)))
+    self.starts = array.array('i', [0]) * len(self.slots)
+    position = array.array('i', self.inverse[:num_slots])
+    for slot in range(num_slots):
+      for occlud in filled[slot]:
+        self.starts[position[occlud]] = slot
+        position[occlud] += 1
+
+  def __getitem__(self, slot):
+    """The slots a lesson starting in slot fills."""
+    return self.slots[self.start[slot]:self.start[slot+1]]
+
+  def Starts(self, slot):
+    """The start slots of the lessons which would fill slot."""
+    return self.starts[self.inverse[slot]:self.inverse[slot+1]]
+
+  def __str__(self):
+    return str([list(self[slot]) for slot in range(len(self.start) - 1)])
+
+
 class Constraints:
   def __init__(self, default_length):
     self.default_length = default_length
@@ -69,8 +154,8 @@ class Constraints:
                                      # pupil zero is the instructor.
     self.pupil_num_lessons = []  # The number of lessons this pupil has.
     self.pupil_lesson_length = []  # The length of the lesson in minutes.
-    self.pupil_slot_occlusion = []  # pupil x slot x slot it would fill.
-    self.slot_pupil_occlusion = []  # slot x pupil x slot that if filled would occlud this slot.
+    self.pupil_slot_occlusion = []  # pupil to the SlotOcclusion of their
+                                    # lesson length, None for pupil zero.
     self.day_range = [(0, 24*60) for _ in range(7)]
     self.slots_by_day = [None] * 7
     self.day_to_number = {'M' : 0, 'T' : 1, 'W' : 2, 'R' : 3,
@@ -86,7 +171,6 @@ class Constraints:
             '\nself.pupil_num_lessons: ' + str(self.pupil_num_lessons) +
             '\nself.pupil_lesson_length: ' + str(self.pupil_lesson_length) +
             '\nself.pupil_slot_occlusion: ' + str(self.pupil_slot_occlusion) +
-            '\nself.slot_pupil_occlusion: ' + str(self.slot_pupil_occlusion) +
             '\nself.day_range: ' + str(self.day_range) +
             '\nself.slots_by_day: ' + str(self.slots_by_day))
 
@@ -187,44 +271,23 @@ class Constraints:
   def DetermineSlotOcclusion(self):
     """Determine the slot occlusions.
 
-    First we determine every slot that a pupil would take up (occlud) if
-    it was scheduled at that time.  This information is saved as
-    self.pupil_slot_occlusion.  Then we invert this mapping to
-    produce self.slot_pupil_occlusion.  Meaning, given a slot and a pupil,
-    provide all the slots which would produce an occlusion.
+    For every pupil, determine every slot that a lesson would take up
+    (occlud) if it was scheduled at a given time, and the inverse, the
+    slots which would occlud a given slot.  Both only depend on the
+    length of the lesson, so they are computed once per length.
     """
-    self.pupil_slot_occlusion = [[None] * self.num_slots for _ in range(self.num_pupils)]
-    self.pupil_slot_occlusion[0] = None
+    occlusion_by_length = dict()
+    self.pupil_slot_occlusion = [None] * self.num_pupils
     for pupil in range(1, self.num_pupils):
-      for day in range(7):
-        slots = []
-        for slot_index in range(len(self.slots_by_day[day])):
-          slot = self.slots_by_day[day][slot_index]
-          lesson_length_left = self.pupil_lesson_length[pupil]
-          offset = 0
-          slots = []
-          while (lesson_length_left > 0 and
-                 slot_index+offset < len(self.slots_by_day[day])):
-            new_slot = self.slots_by_day[day][slot_index+offset]
-            slots.append(new_slot)
-            assert self.slot_time[new_slot].length
-            lesson_length_left -= self.slot_time[new_slot].length
-            offset += 1
-          if lesson_length_left <= 0:
-            self.pupil_slot_occlusion[pupil][slot] = slots
-          else:
-            # Unable to schedule.
-            self.pupil_slot_occlusion[pupil][slot] = []
-            self.pupil_slot_preference[pupil][slot] = 0
-    self.slot_pupil_occlusion = [[None] * self.num_pupils for _ in range(self.num_slots)]
-    for pupil in range(1, self.num_pupils):
-      for day in range(7):
-        for slot in self.slots_by_day[day]:
-          for occlud in self.pupil_slot_occlusion[pupil][slot]:
-            if self.slot_pupil_occlusion[occlud][pupil]:
-              self.slot_pupil_occlusion[occlud][pupil].append(slot)
-            else:
-              self.slot_pupil_occlusion[occlud][pupil] = [slot]
+      length = self.pupil_lesson_length[pupil]
+      if length not in occlusion_by_length:
+        occlusion_by_length[length] = SlotOcclusion(
+            length, self.num_slots, self.slot_time, self.slots_by_day)
+      occlusion = occlusion_by_length[length]
+      self.pupil_slot_occlusion[pupil] = occlusion
+      for slot in occlusion.unfit_slots:
+        # Unable to schedule.
+        self.pupil_slot_preference[pupil][slot] = 0
 
   def DetermineDayStartEndTimes(self):
     """Determine the start and end times of each workday.
@@ -260,23 +323,39 @@ class Constraints:
 
 
 class Scheduler:
-  def __init__(self, spec, solver_run):
+  def __init__(self, spec, solver_run, thread_budget=None):
     pref = solver_run.options
 
     self.solver_run = solver_run
+    self.thread_budget = thread_budget
     self.solver_run.version = version_number
+    self.solver_output_size = 0
+    # The result of the search: the solver's status, the objective and
+    # values of the variables of its model (or None without a model).
+    self.solver_status = None
+    self.solver_objective = None
+    self.solver_values = None
+    self.output_schedule = None
+    self.saved_score = None  # Of the schedule last saved.
+    # A copied schedule of an earlier run which this run improves on.
+    self.cached_schedule = None
+    # The values of the solution the objective is bounded by, if any.
+    self.start_values = None
+    self.replay_values = None
 
     self.spec = spec
-    self.next_var = 1
-    self.x_name = dict()
-    self.our_name = dict()
-    self.available = dict()
-    self.fixed_value = dict()
-    self.constraints = []
-    self.objective = []
-    self.all_products = dict()
-    self.max_product_size = 0
+    self.model = pbmodel.PseudoBooleanModel()
+    # pupil x slot tables.  var_id holds the solver variable number, or -1
+    # if the value is fixed (in which case fixed_value holds 0 or 1).
+    self.var_id = []
+    self.fixed_value = []
+    # Solver variable number to (pupil, slot), entry 0 is unused.
+    self.var_pupil_slot = [None]
+    # Pupil to the lesson slots kept from an earlier schedule.
+    self.kept_lessons = dict()
     self.all_objectives = dict()
+    # Day to its FreeChain, whose last element is whether the day is off.
+    self.day_off = dict()
 
     self.arrive_late_bonus = int(pref.arrive_late_bonus)
     self.leave_early_bonus = int(pref.leave_early_bonus)
@@ -294,75 +373,460 @@ class Scheduler:
     self.complex_constraints = list()
 
   def __str__(self):
-    return ('self.x_name: ' + str(self.x_name) +
-            '\nself.our_name: ' + str(self.our_name) +
-            '\nself.constraints:\n' + '\n'.join(self.constraints) +
-            '\n\n\nself.objective:\n' + '\n'.join(self.objective))
+    return ('self.var_id: ' + str(self.var_id) +
+            '\nself.var_pupil_slot: ' + str(self.var_pupil_slot) +
+            '\nself.model.constraints:\n' + '\n'.join(
+                [pbmodel.ConstraintString(c) for c in self.model.constraints]) +
+            '\n\n\nself.model.objective:\n' + '\n'.join(
+                [pbmodel.TermString(t) for t in self.model.objective]))
+
+  def CacheKey(self):
+    """Hash of everything which determines the result of the run."""
+    data = (
+        version_number,
+        self.spec.default_length,
+        self.spec.slot_name,
+        self.spec.pupil_name,
+        self.spec.pupil_slot_preference,
+        self.spec.pupil_num_lessons,
+        self.spec.pupil_lesson_length,
+        self.arrive_late_bonus,
+        self.leave_early_bonus,
+        self.day_off_bonus,
+        self.pupil_preference_penalty,
+        self.instructor_preference_penalty,
+        self.no_break_penalty,
+        self.complex_constraints_string.strip(),
+    )
+    return hashlib.sha256(repr(data).encode('utf-8')).hexdigest()
+
+  def UseCachedResult(self):
+    """Reuse the schedule of an earlier run of the same problem.
+
+    Returns True if that schedule is optimal, which completes this run.  A
+    schedule which isn't known to be optimal is copied so that it is
+    available right away, and this run goes on to improve on it (see
+    cached_schedule).
+    """
+    self.solver_run.cache_key = self.CacheKey()
+    self.solver_run.save()
+    schedules = Schedule.objects.filter(
+        deleted=False, score__isnull=False,
+        created_by__cache_key=self.solver_run.cache_key,
+        created_by__deleted=False,
+        created_by__state=SolverRun.DONE).exclude(
+            created_by=self.solver_run)
+    cached = schedules.filter(
+        created_by__solution=SolverRun.OPTIMAL).order_by('-score').first()
+    optimal = cached is not None
+    if not optimal:
+      cached = schedules.order_by('-score').first()
+    if cached is None:
+      return False
+
+    self.CopySchedule(cached)
+    if optimal:
+      self.solver_run.scheduler_output += (
+          'Reused the optimal schedule of solver run ' +
+          str(cached.created_by.id) + '.\n')
+      self.solver_run.solution = SolverRun.OPTIMAL
+      self.solver_run.state = SolverRun.DONE
+    else:
+      self.solver_run.scheduler_output += (
+          'Copied the schedule of solver run ' + str(cached.created_by.id) +
+          ', solving again to improve on it.\n')
+      self.solver_run.solution = SolverRun.SOLUTION
+      self.cached_schedule = cached
+    self.solver_run.save()
+    return optimal
+
+  def CopySchedule(self, schedule):
+    """Give this run a copy of schedule (from another run)."""
+    copy = Schedule()
+    copy.score = schedule.score
+    copy.schedule = schedule.schedule
+    copy.assignment = schedule.assignment
+    copy.created_by = self.solver_run
+    copy.save()
+    self.solver_run.score = schedule.score
+    self.saved_score = schedule.score
+    return copy
+
+  def AssignmentFromSchedule(self, schedule):
+    """The solver variable values of schedule, or None if not possible.
+
+    The returned list is indexed by solver variable number.
+    """
+    if not schedule.assignment:
+      # Made before schedules recorded their assignment.
+      return None
+    pupil_slots = ast.literal_eval(schedule.assignment)
+    pupil_by_name = dict(
+        [(name, pupil) for pupil, name in enumerate(self.spec.pupil_name)])
+    slot_by_name = dict(
+        [(name, slot) for slot, name in enumerate(self.spec.slot_name)])
+    values = [False] * (self.model.num_variables + 1)
+    for pupil_name, slot_names in pupil_slots.items():
+      if pupil_name not in pupil_by_name:
+        return None
+      pupil = pupil_by_name[pupil_name]
+      for slot_name in slot_names:
+        if slot_name not in slot_by_name:
+          return None
+        slot = slot_by_name[slot_name]
+        var = self.var_id[pupil][slot]
+        if var < 0:
+          if self.fixed_value[pupil][slot] == 1:
+            continue
+          return None
+        values[var] = True
+        # The instructor is busy for every slot the lesson occludes.
+        for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+          if self.var_id[0][occlud] >= 0:
+            values[self.var_id[0][occlud]] = True
+    pbmodel.SetDefinedVariables(self.model, values)
+    for constraint in self.model.constraints:
+      if not pbmodel.ConstraintSatisfied(constraint, values):
+        return None
+    return values
+
+  def AddWarmStart(self, schedule, copy=True):
+    """Only accept solutions at least as good as schedule.
+
+    clasp has no way to be given a starting assignment, so this bounds the
+    objective by the value of schedule instead.  The run gets a copy of
+    schedule unless copy is False (it already has one).  Returns False
+    (leaving the model alone) if schedule is not a solution of this model.
+    """
+    values = self.AssignmentFromSchedule(schedule)
+    if values is None:
+      self.solver_run.scheduler_output += (
+          'Unable to warm start from schedule ' + str(schedule.id) +
+          ', it is not a solution of this problem.\n')
+      return False
+    bound = self.BoundObjectiveByValues(values)
+    if copy:
+      self.CopySchedule(schedule)
+    self.solver_run.score = -(bound + self.total_correction)
+    # The run has (a copy of) schedule, a result no better isn't saved again.
+    self.saved_score = self.solver_run.score
+    self.solver_run.solution = SolverRun.SOLUTION
+    self.solver_run.scheduler_output += (
+        'Warm starting from schedule ' + str(schedule.id) +
+        ' with score ' + str(self.solver_run.score) + '.\n')
+    return True
 
-  def Prepare(self):
+  def CheckLessonCapacity(self):
+    """Check that every lesson can have a start slot of its own.
+
+    Returns None if so (a schedule may still not exist), otherwise an
+    explanation of why there is no schedule.
+    """
     self.MakeAvailabilityDict()
-    self.MakeAllVariables()
+    num_lessons = dict()
+    start_slots = dict()
+    for pupil in range(1, self.spec.num_pupils):
+      num_lessons[pupil] = self.spec.pupil_num_lessons[pupil]
+      start_slots[pupil] = [slot for slot in range(self.spec.num_slots)
+                            if self.fixed_value[pupil][slot] is None]
+    slot_day = dict([(slot, self.spec.slot_time[slot].day)
+                     for slot in range(self.spec.num_slots)])
+    violator = precheck.FindHallViolator(num_lessons, start_slots, slot_day)
+    if violator is None:
+      return None
+    (pupils, needed, possible, slots) = violator
+    explanation = (
+        'Impossible: ' +
+        ', '.join([self.spec.pupil_name[pupil] for pupil in pupils]) +
+        ' need ' + str(needed) + ' lessons between them but at most ' +
+        str(possible) + ' fit in the slots they can start in (' +
+        (', '.join([self.spec.slot_name[slot] for slot in slots]) or 'none') +
+        ')')
+    if any([num_lessons[pupil] > 1 for pupil in pupils]):
+      explanation += ' with one lesson a day per pupil'
+    return explanation + '.\n'
+
+  def BoundObjective(self, bound, terms=None):
+    """Only accept solutions whose objective (or terms) is at most bound."""
+    if terms is None:
+      terms = self.model.objective
+    self.model.AddConstraint(
+        [pbmodel.Term(-term.coefficient, term.literals) for term in terms],
+        '>=', -bound)
+
+  def BoundObjectiveByValues(self, values):
+    """Only accept solutions at least as good as the one given by values.
+
+    Each independent component of the model is bounded by its own part of
+    the objective of values, so the components stay independent (and can
+    still be solved separately).  The best solutions are not lost, in
+    those every component is at its best.  Returns the objective of values.
+    """
+    component = dict()
+    for index, variables in enumerate(self.model.Components()):
+      for var in variables:
+        component[var] = index
+    component_terms = dict()
+    for term in self.model.objective:
+      component_terms.setdefault(
+          component[abs(term.literals[0])], []).append(term)
+    for index, terms in sorted(component_terms.items()):
+      self.BoundObjective(pbmodel.EvaluateTerms(terms, values), terms)
+    self.start_values = values
+    return pbmodel.EvaluateTerms(self.model.objective, values)
+
+  def SaveGreedySchedule(self):
+    """Save a provisional schedule found without the solver.
+
+    Only done if it is better than the run's schedule so far.  Returns the
+    values of the variables, or None if no such schedule was found.
+    """
+    start_time = time.time()
+    values = greedy.GreedyScheduler(
+        self, settings.SOLVER_GREEDY_TIME_LIMIT).Run()
+    if values is None:
+      self.solver_run.scheduler_output += (
+          'No provisional schedule found.\n')
+      return None
+    score = -(pbmodel.EvaluateTerms(self.model.objective, values) +
+              self.total_correction)
+    self.solver_run.scheduler_output += (
+        'Provisional schedule with score ' + str(score) + ' found in ' +
+        str(int((time.time() - start_time) * 1000)) + ' ms.\n')
+    if self.solver_run.score is not None and score <= self.solver_run.score:
+      return None
+    self.solver_run.score = score
+    self.solver_run.solution = SolverRun.SOLUTION
+    self.x_solution = values
+    self.SaveSchedule(self.TrueVariables(values))
+    self.solver_run.save()
+    return values
+
+  def AddGreedyStart(self):
+    """Save a provisional schedule and only accept better solutions."""
+    values = self.SaveGreedySchedule()
+    if values is None:
+      return False
+    self.BoundObjectiveByValues(values)
+    return True
+
+  def KeepUnaffectedLessons(self, parent_spec, parent_schedule):
+    """Only re-optimize the pupils affected by an edit of the availability.
 
-    self.MakeSlotConstraints()
-    self.MakePupilConstraints()
-    self.MakeComplexConstraints()
+    Pupils whose row is unchanged since parent_spec keep their lessons
+    from parent_schedule, unless those lessons use slots whose instructor
+    availability changed or slots a changed pupil could be scheduled in
+    (the neighborhood of the edit).  Must be called before Prepare.
+    Returns the number of pupils kept.
+    """
+    self.kept_lessons = dict()
+    if (not parent_schedule.assignment or
+        parent_spec.slot_name != self.spec.slot_name):
+      return 0
+    self.MakeAvailabilityDict()
+    previous_lessons = ast.literal_eval(parent_schedule.assignment)
+    parent_pupil = dict(
+        [(name, pupil) for pupil, name in enumerate(parent_spec.pupil_name)])
+    slot_by_name = dict(
+        [(name, slot) for slot, name in enumerate(self.spec.slot_name)])
+
+    contested = set([
+        slot for slot in range(self.spec.num_slots)
+        if (self.spec.pupil_slot_preference[0][slot] !=
+            parent_spec.pupil_slot_preference[0][slot])])
+    candidates = dict()
+    for pupil in range(1, self.spec.num_pupils):
+      name = self.spec.pupil_name[pupil]
+      parent = parent_pupil.get(name)
+      slots = [slot_by_name[slot_name]
+               for slot_name in previous_lessons.get(name, [])]
+      if (parent is not None and
+          parent_spec.pupil_slot_preference[parent] ==
+              self.spec.pupil_slot_preference[pupil] and
+          parent_spec.pupil_num_lessons[parent] ==
+              self.spec.pupil_num_lessons[pupil] and
+          parent_spec.pupil_lesson_length[parent] ==
+              self.spec.pupil_lesson_length[pupil] and
+          len(slots) == self.spec.pupil_num_lessons[pupil] and
+          all([self.fixed_value[pupil][slot] is None for slot in slots])):
+        candidates[pupil] = slots
+        continue
+      # Changed pupil, anywhere they could go is part of the neighborhood.
+      for slot in range(self.spec.num_slots):
+        if self.fixed_value[pupil][slot] is None:
+          contested.update(self.spec.pupil_slot_occlusion[pupil][slot])
+    for pupil, slots in candidates.items():
+      occluded = set()
+      for slot in slots:
+        occluded.update(self.spec.pupil_slot_occlusion[pupil][slot])
+      if not occluded & contested:
+        self.kept_lessons[pupil] = slots
+    return len(self.kept_lessons)
+
+  def FixKeptLessons(self):
+    """Fix the variables of the pupils in kept_lessons."""
+    for pupil, slots in self.kept_lessons.items():
+      fixed_value = self.fixed_value[pupil]
+      for slot in range(self.spec.num_slots):
+        fixed_value[slot] = 0
+      for slot in slots:
+        fixed_value[slot] = 1
+        for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+          # The instructor is busy and nobody else can use the slot.
+          self.fixed_value[0][occlud] = 1
+          for other in range(1, self.spec.num_pupils):
+            if other != pupil:
+              for other_slot in (
+                  self.spec.pupil_slot_occlusion[other].Starts(occlud)):
+                self.fixed_value[other][other_slot] = 0
 
-    self.MakePreferencePenalty()
-    self.MakeArriveLateBonus()
-    self.MakeLeaveEarlyBonus()
-    self.MakeNoBreakPenalty()
-    self.MakeDayOffBonus()
+  def Prepare(self):
+    with TimePhase(self.solver_run, 'Prepare'):
+      for step in [
+          self.MakeAvailabilityDict,
+          self.FixKeptLessons,
+          self.MakeAllVariables,
+
+          self.MakeSlotConstraints,
+          self.MakePupilConstraints,
+          self.MakeComplexConstraints,
+
+          self.MakePreferencePenalty,
+          self.MakeArriveLateBonus,
+          self.MakeLeaveEarlyBonus,
+          self.MakeNoBreakPenalty,
+          self.MakeDayOffBonus]:
+        with TimePhase(self.solver_run, 'Prepare/' + step.__name__):
+          step()
+
+      if settings.SOLVER_PRESOLVE:
+        with TimePhase(self.solver_run, 'Prepare/Presolve'):
+          self.Presolve()
 
     self.total_correction = 0
     for name, objective_pair in self.all_objectives.items():
       (unused_objective, correction) = objective_pair
       self.total_correction += correction
-
-  def MakeVariable(self, var_name):
-    x_name = 'x'+str(self.next_var)
-    self.x_name[var_name] = x_name
-    self.our_name[x_name] = var_name
-    self.next_var += 1
-    return x_name
+    if not self.solver_run.model_size:
+      self.solver_run.model_size = repr(self.ModelSize())
+
+  def ModelSize(self):
+    """The size of the model, see SolverRun.model_size."""
+    objectives = []
+    for name, (objective, unused_correction) in sorted(
+        self.all_objectives.items()):
+      objectives.append((
+          name, len(objective),
+          sum([len(term.literals) for term in objective]),
+          len([term for term in objective if len(term.literals) > 1])))
+    return {
+        'variables': self.model.num_variables,
+        'constraints': len(self.model.constraints),
+        'constraint_literals': sum(
+            [len(term.literals) for constraint in self.model.constraints
+             for term in constraint.terms]),
+        'objectives': objectives,
+    }
+
+  def Presolve(self):
+    """Simplify the model before it is given to the solver.
+
+    Variables forced by the constraints are fixed, for example the slots
+    of a pupil with as many possible slots as lessons.  The variable of an
+    instructor slot which only one pupil slot can fill is replaced by that
+    pupil slot's variable.  The products shrink to match.  Fixed variables
+    go into var_id and fixed_value as if they had never been made.
+    """
+    presolver = pbmodel.Presolver(self.model)
+    if not presolver.Run():
+      # Leave the model alone, the solver will prove it impossible.
+      self.solver_run.scheduler_output += (
+          'Presolve found the problem to be impossible.\n')
+      return
+    model = presolver.MakeModel()
+    var_pupil_slot = [None] * (model.num_variables + 1)
+    for var in range(1, self.model.num_variables + 1):
+      if self.var_pupil_slot[var] is None:
+        # Made by MakeProductVariable, not part of the schedule.
+        continue
+      (pupil, slot) = self.var_pupil_slot[var]
+      value = presolver.Value(var)
+      if value is None:
+        self.var_id[pupil][slot] = presolver.number[
+            presolver.Representative(var)]
+        if var in presolver.number:
+          var_pupil_slot[presolver.number[var]] = (pupil, slot)
+      else:
+        self.var_id[pupil][slot] = -1
+        self.fixed_value[pupil][slot] = int(value)
+    for name, objective_pair in self.all_objectives.items():
+      (objective, correction) = objective_pair
+      (objective, constant) = presolver.SimplifyTerms(objective)
+      self.all_objectives[name] = (objective, correction + constant)
+      model.objective.extend(objective)
+    self.solver_run.scheduler_output += (
+        'Presolve removed ' +
+        str(self.model.num_variables - model.num_variables) + ' variables (' +
+        str(len(presolver.value)) + ' fixed, ' +
+        str(len(presolver.alias)) + ' replaced), ' +
+        str(len(self.model.constraints) - len(model.constraints)) +
+        ' constraints and ' +
+        str(pbmodel.NumLiterals(self.model) - pbmodel.NumLiterals(model)) +
+        ' literals.\n')
+    self.model = model
+    self.var_pupil_slot = var_pupil_slot
+
+  def MakeVariable(self, pupil, slot):
+    var = self.model.NewVariable()
+    self.var_id[pupil][slot] = var
+    self.var_pupil_slot.append((pupil, slot))
+    return var
+
+  def MakeProductVariable(self, literals):
+    """A variable for the product of literals, see NewProduct."""
+    self.var_pupil_slot.append(None)
+    return self.model.NewProduct(literals)
 
   def MakeAllVariables(self):
     for pupil in range(self.spec.num_pupils):
+      fixed_value = self.fixed_value[pupil]
       for slot in range(self.spec.num_slots):
-        var_name = 'p'+str(pupil)+'s'+str(slot)
-        if self.available[var_name]:
-          self.MakeVariable(var_name)
+        if fixed_value[slot] is None:
+          self.MakeVariable(pupil, slot)
 
   def MakeAvailabilityDict(self):
     # Go through availabilities and mark the variables that we need.
+    # A fixed_value of None means the variable is free.
+    self.var_id = [
+        [-1] * self.spec.num_slots for _ in range(self.spec.num_pupils)]
+    self.fixed_value = [
+        [None] * self.spec.num_slots for _ in range(self.spec.num_pupils)]
+    instructor_preference = self.spec.pupil_slot_preference[0]
     for slot in range(self.spec.num_slots):
-      for pupil in range(self.spec.num_pupils):
-        var_name = 'p'+str(pupil)+'s'+str(slot)
-        # This slot is only available if it is marked as available directly
-        # and if all of the slots it would occlud are marked as available
-        # for the instructor.
-        if pupil == 0:
-          self.available[var_name] = (
-              self.spec.pupil_slot_preference[pupil][slot] > 0)
-          if not self.available[var_name]:
-            if self.spec.pupil_slot_preference[pupil][slot] == -1:
-              # Consider this slot busy
-              self.fixed_value[var_name] = 1
-            else:
-              self.fixed_value[var_name] = 0
+      # This slot is only available if it is marked as available directly
+      # and if all of the slots it would occlud are marked as available
+      # for the instructor.
+      if instructor_preference[slot] <= 0:
+        if instructor_preference[slot] == -1:
+          # Consider this slot busy
+          self.fixed_value[0][slot] = 1
         else:
-          self.available[var_name] = False
-          if self.spec.pupil_slot_preference[pupil][slot] > 0:
-            if (self.spec.pupil_slot_occlusion[pupil] and
-                self.spec.pupil_slot_occlusion[pupil][slot]):
-              # Check the instructor for each of the slots it would occlud.
-              available = True
-              for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
-                if self.spec.pupil_slot_preference[0][occlud] <= 0:
-                  available = False
-                  break
-              self.available[var_name] = available
-          if not self.available[var_name]:
-            self.fixed_value[var_name] = 0
+          self.fixed_value[0][slot] = 0
+    for pupil in range(1, self.spec.num_pupils):
+      preference = self.spec.pupil_slot_preference[pupil]
+      occlusion = self.spec.pupil_slot_occlusion[pupil]
+      fixed_value = self.fixed_value[pupil]
+      for slot in range(self.spec.num_slots):
+        available = False
+        if preference[slot] > 0 and occlusion and occlusion[slot]:
+          # Check the instructor for each of the slots it would occlud.
+          available = True
+          for occlud in occlusion[slot]:
+            if instructor_preference[occlud] <= 0:
+              available = False
+              break
+        if not available:
+          fixed_value[slot] = 0
 
   def MakeSlotConstraints(self):
     """Each lesson needs exactly one teacher per student.
@@ -372,42 +836,40 @@ class Scheduler:
     """
     # Each session needs an instructor and only has 1 student.
     for slot in range(self.spec.num_slots):
-      x_names = []
-      if not self.available['p0s'+str(slot)]:
+      if self.var_id[0][slot] < 0:
         continue
+      terms = []
       for pupil in range(1, self.spec.num_pupils):
-        for pupil_slot in self.spec.slot_pupil_occlusion[slot][pupil]:
+        var_id = self.var_id[pupil]
+        for pupil_slot in self.spec.pupil_slot_occlusion[pupil].Starts(slot):
           # Consider all slots that would occlud this slot if we scheduled them.
-          var_name = 'p'+str(pupil)+'s'+str(pupil_slot)
-          if self.available[var_name]:
-            x_names.append(self.x_name[var_name])
-      if x_names:
-        self.constraints.append('1 ' + self.x_name['p0s'+str(slot)] + ' -1 ' +
-                                ' -1 '.join(x_names) + ' = 0;')
+          if var_id[pupil_slot] >= 0:
+            terms.append(pbmodel.Term(-1, (var_id[pupil_slot],)))
+      if terms:
+        self.model.AddConstraint(
+            [pbmodel.Term(1, (self.var_id[0][slot],))] + terms, '=', 0)
 
   def MakePupilConstraints(self):
     """Each pupil must have the correct number of sessions."""
     # Remember that pupil 0 is the instructor.
     for pupil in range(1, self.spec.num_pupils):
-      x_names = []
-      for slot in range(self.spec.num_slots):
-        var_name = 'p'+str(pupil)+'s'+str(slot)
-        if self.available[var_name]:
-          x_names.append(self.x_name[var_name])
-      assert x_names, ('pupil ' + self.spec.pupil_name[pupil] +
-                       ' has no available slots.')
-      self.constraints.append('1 ' + ' +1 '.join(x_names) + ' = ' +
-                              str(self.spec.pupil_num_lessons[pupil]) + ';')
+      if pupil in self.kept_lessons:
+        # All of this pupil's variables are fixed.
+        continue
+      var_id = self.var_id[pupil]
+      terms = [pbmodel.Term(1, (var,)) for var in var_id if var >= 0]
+      assert terms, ('pupil ' + self.spec.pupil_name[pupil] +
+                     ' has no available slots.')
+      self.model.AddConstraint(
+          terms, '=', self.spec.pupil_num_lessons[pupil])
       if self.spec.pupil_num_lessons[pupil] > 1:
         # Restrict multiple lessons to different days.
         for day in range(7):
-          x_names = []
-          for slot in self.spec.slots_by_day[day]:
-            var_name = 'p'+str(pupil)+'s'+str(slot)
-            if self.available[var_name]:
-              x_names.append(self.x_name[var_name])
-          if x_names:
-            self.constraints.append('-1 ' + ' -1 '.join(x_names) + ' >= -1;')
+          terms = [pbmodel.Term(-1, (var_id[slot],))
+                   for slot in self.spec.slots_by_day[day]
+                   if var_id[slot] >= 0]
+          if terms:
+            self.model.AddConstraint(terms, '>=', -1)
 
   def SetComplexConstraintIntervals(self):
     self.complex_constraint_intervals = list()
@@ -477,55 +939,52 @@ class Scheduler:
       terms = []
       for slots in constraint_list:
         (possible, term) = self.MakeProd(1, slots, 0, True)
-        if term:
+        if term is not None:
           terms.append(term)
         else:
           true_terms += possible
       if terms and true_terms < 1:
-        self.constraints.append(' '.join(terms) + ' >= 1;')
+        self.model.AddConstraint(terms, '>=', 1)
 
   def MakeProd(self, penalty, slots, pupil=0, negations=False):
+    """Make a term for penalty times the product of the slot variables.
+
+    Returns (penalty, term) with term None if the product has a fixed
+    value.  In that case penalty is the value of the term (0 if the
+    product is false).
+    """
     if isinstance(negations, list):
       assert len(slots) == len(negations)
     else:
       negations = [negations for i in range(len(slots))]
     if penalty == 0:
       # Whether true or not this term is irrelevant.
-      return (0, '')
-    x_names = []
+      return (0, None)
+    var_id = self.var_id[pupil]
+    fixed_value = self.fixed_value[pupil]
+    literals = []
     for i in range(len(slots)):
       slot = slots[i]
-      var_name = 'p'+str(pupil)+'s'+str(slot)
-      if not self.available[var_name]:
+      if var_id[slot] < 0:
         # fixed == 1 and negation means prod has value 0
         # and fixed == 0 and not negation means prod has value 0
         # otherwise the value for this term is 1 and the sum goes on.
-        if self.fixed_value[var_name] == negations[i]:
+        if fixed_value[slot] == negations[i]:
           # Product is false.
-          return (0, '')
+          return (0, None)
         else:
           continue
       if negations[i]:
-        x_names.append('~'+self.x_name[var_name])
+        literals.append(-var_id[slot])
       else:
-        x_names.append(self.x_name[var_name])
+        literals.append(var_id[slot])
 
-    if not x_names:
+    if not literals:
       # Product is always true.
-      return (penalty, '')
-
-    if penalty > 0:
-      penalty_str = '+' + str(penalty)
-    else:
-      penalty_str = str(penalty)
+      return (penalty, None)
 
-    x_names.sort(key=ValFromXVar)
-
-    product = ' '.join(x_names)
-    if len(x_names) > 1:
-      self.all_products[product] = 1
-      self.max_product_size = max(self.max_product_size, len(x_names))
-    return (penalty, penalty_str + ' ' + product)
+    literals.sort(key=abs)
+    return (penalty, self.model.MakeTerm(penalty, literals))
 
   def MakePreferencePenalty(self):
     instructor_objective = list()
@@ -546,7 +1005,7 @@ class Scheduler:
                   self.spec.pupil_slot_preference[pupil][slot]-2] *
                   self.spec.slot_time[slot].length)
           (penalty, term) = self.MakeProd(penalty, [slot], pupil, False)
-          if term:
+          if term is not None:
             if pupil == 0:
               instructor_objective.append(term)
             else:
@@ -560,13 +1019,21 @@ class Scheduler:
         instructor_objective, instructor_correction)
     self.all_objectives['pupil preference'] = (
         pupil_objective, pupil_correction)
-    self.objective.extend(instructor_objective)
-    self.objective.extend(pupil_objective)
+    self.model.objective.extend(instructor_objective)
+    self.model.objective.extend(pupil_objective)
 
   def MakeArriveLateBonus(self):
+    # Assign a bonus for every minute the instructor comes in late.
+    if settings.SOLVER_DAY_BONUS_ENCODING == 'products':
+      (objective, correction) = self.MakeArriveLateProducts()
+    else:
+      (objective, correction) = self.MakeArriveLateChains()
+    self.all_objectives['arrive late'] = (objective, correction)
+    self.model.objective.extend(objective)
+
+  def MakeArriveLateProducts(self):
     objective = list()
     correction = 0
-    # Assign a bonus for every minute the instructor comes in late.
     for day in range(7):
       slots = []
       for slot in self.spec.slots_by_day[day]:
@@ -576,19 +1043,44 @@ class Scheduler:
                                             self.spec.slot_time[slots[0]].time)
           negations = [1] * (len(slots)-1) + [0]
           (actual_penalty, term) = self.MakeProd(-bonus, slots, 0, negations)
-          if term:
+          if term is not None:
             objective.append(term)
           else:
             correction += actual_penalty
-    self.all_objectives['arrive late'] = (objective, correction)
-    self.objective.extend(objective)
+    return (objective, correction)
+
+  def MakeArriveLateChains(self):
+    chains = []
+    bonuses = []
+    for day in range(7):
+      slots = self.spec.slots_by_day[day]
+      if not slots:
+        chains.append([])
+        bonuses.append([])
+        continue
+      self.DayOff(day)
+      chains.append(self.day_off[day])
+      start_time = self.spec.slot_time[slots[0]].time
+      bonuses.append(
+          [self.arrive_late_bonus * (self.spec.slot_time[slot].time -
+                                     start_time)
+           for slot in slots])
+    return self.MakeFreeEndBonus(chains, bonuses)
 
   def MakeLeaveEarlyBonus(self):
-    objective = list()
-    correction = 0
     # Assign a bonus for every minute the instructor leaves early.
     # TODO(mgeorg) This isn't perfect, it assumes that the entire slot
     # is used, when a lesson might have just barely used some time up.
+    if settings.SOLVER_DAY_BONUS_ENCODING == 'products':
+      (objective, correction) = self.MakeLeaveEarlyProducts()
+    else:
+      (objective, correction) = self.MakeLeaveEarlyChains()
+    self.all_objectives['leave early'] = (objective, correction)
+    self.model.objective.extend(objective)
+
+  def MakeLeaveEarlyProducts(self):
+    objective = list()
+    correction = 0
     for day in range(7):
       slots = []
       for slot in reversed(self.spec.slots_by_day[day]):
@@ -601,54 +1093,117 @@ class Scheduler:
               -self.spec.slot_time[slot].length)
           negations = [1] * (len(slots)-1) + [0]
           (actual_penalty, term) = self.MakeProd(-bonus, slots, 0, negations)
-          if term:
+          if term is not None:
             objective.append(term)
           else:
             correction += actual_penalty
-    self.all_objectives['leave early'] = (objective, correction)
-    self.objective.extend(objective)
+    return (objective, correction)
 
-  def MakeNoBreakPenalty(self):
-    length_to_penalty = dict()
+  def MakeLeaveEarlyChains(self):
+    chains = []
+    bonuses = []
+    for day in range(7):
+      slots = list(reversed(self.spec.slots_by_day[day]))
+      if not slots:
+        chains.append([])
+        bonuses.append([])
+        continue
+      chains.append(self.FreeChain(slots, self.DayOff(day)))
+      end_time = (self.spec.slot_time[slots[0]].time +
+                  self.spec.slot_time[slots[0]].length)
+      bonuses.append(
+          [self.leave_early_bonus * (end_time -
+                                     self.spec.slot_time[slot].time -
+                                     self.spec.slot_time[slot].length)
+           for slot in slots])
+    return self.MakeFreeEndBonus(chains, bonuses)
+
+  def MakeFreeEndBonus(self, chains, bonuses):
+    """A bonus for the free slots at one end of each working day.
+
+    chains[day][j] is whether the first j+1 slots of the day (from that
+    end) are free, with the last one whether the day is off.
+    bonuses[day][j] is the bonus if the instructor starts working in the
+    day's j-th slot, 0 for the first.  Instead of a product for each
+    start, a free run of j+1 slots earns the bonus of the next slot over
+    the previous one, and a day off takes back the whole bonus.
+    """
+    objective = list()
+    correction = 0
+    for day in range(7):
+      chain = chains[day]
+      bonus = bonuses[day]
+      for j in range(len(chain)):
+        if j < len(chain) - 1:
+          penalty = -(bonus[j+1] - bonus[j])
+        else:
+          penalty = bonus[j]
+        (actual_penalty, term) = self.MakeLiteralTerm(penalty, chain[j])
+        if term is not None:
+          objective.append(term)
+        else:
+          correction += actual_penalty
+    return (objective, correction)
 
-    k,v = self.no_break_penalty[0]
+  def NoBreakRate(self, minutes):
+    """The no break penalty per minute of a stretch without a break.
+
+    Interpolated linearly between the configured lengths, constant before
+    the first and continuing the last slope (if it is increasing) after
+    the last.
+    """
+    (k, v) = self.no_break_penalty[0]
+    if minutes < k:
+      return float(v)
     diff = 0
-    for i in range(k):
-      length_to_penalty[i] = float(v)
     for index in range(len(self.no_break_penalty)-1):
       k1,v1 = self.no_break_penalty[index]
       k2,v2 = self.no_break_penalty[index+1]
-      r = k2 - k1
-      diff = (1/float(r))*(float(v2)-float(v1))
-      for i in range(r):
-        length_to_penalty[k1 + i] = float(i)*diff + float(v1)
+      diff = (1/float(k2 - k1))*(float(v2)-float(v1))
+      if minutes < k2:
+        return float(minutes - k1)*diff + float(v1)
     if diff < 0:
       diff = 0
-    k,v = self.no_break_penalty[-1]
-    for i in range(k, 24*60):
-      v = float(v) + diff
-      length_to_penalty[i] = v
+    (k, v) = self.no_break_penalty[-1]
+    return float(v) + float(minutes - k + 1)*diff
 
-    objective = list()
-    correction = 0
+  def NoBreakRunPenalty(self, first_slot, last_slot):
+    """The penalty for the instructor working without a break.
+
+    The instructor works from first_slot to last_slot, of the same day.
+    """
+    start_time = self.spec.slot_time[first_slot].time
+    end_time = (self.spec.slot_time[last_slot].time +
+                self.spec.slot_time[last_slot].length)
+    return round(self.NoBreakRate(end_time - start_time) *
+                 float(end_time - start_time) /
+                 float(last_slot - first_slot + 1))
+
+  def MakeNoBreakPenalty(self):
     # Assign a penalty for every minute the instructor doesn't have a
     # break past some allowable threshold.
+    if settings.SOLVER_NO_BREAK_ENCODING == 'products':
+      (objective, correction) = self.MakeNoBreakProducts()
+    else:
+      (objective, correction) = self.MakeNoBreakChains()
+    self.all_objectives['no break'] = (objective, correction)
+    self.model.objective.extend(objective)
+
+  def MakeNoBreakProducts(self):
+    """One term for every stretch of work, with its busy and free ends.
+
+    Each term is a product of all of the stretch's slots, which makes the
+    objective cubic in the number of slots in a day.
+    """
+    objective = list()
+    correction = 0
     for day in range(7):
       for first_slot_index in range(len(self.spec.slots_by_day[day])):
-        first_slot = self.spec.slots_by_day[day][first_slot_index]
-        start_time = self.spec.slot_time[first_slot].time
         slots = []
         for slot_index in range(first_slot_index,
                                 len(self.spec.slots_by_day[day])):
-          slot = self.spec.slots_by_day[day][slot_index]
-          slots.append(slot)
-          end_time = (self.spec.slot_time[slot].time + 
-                      self.spec.slot_time[slot].length)
-          if slots:
-            penalty = round(length_to_penalty[end_time - start_time] *
-                            float(end_time - start_time) / float(len(slots)))
-          else:
-            continue
+          slots.append(self.spec.slots_by_day[day][slot_index])
+          penalty = self.NoBreakRunPenalty(slots[0], slots[-1])
           negations = [0]*len(slots)
           all_slots = slots[:]
           if first_slot_index != 0:
@@ -660,12 +1215,117 @@ class Scheduler:
             all_slots = all_slots + [self.spec.slots_by_day[day][slot_index+1]]
           (actual_penalty, term) = self.MakeProd(
               penalty, all_slots, 0, negations)
-          if term:
+          if term is not None:
             objective.append(term)
           else:
             correction += actual_penalty
-    self.all_objectives['no break'] = (objective, correction)
-    self.objective.extend(objective)
+    return (objective, correction)
+
+  def MakeNoBreakChains(self):
+    """The same penalty with working run length variables.
+
+    run[t][k] is true if the instructor is busy for the k slots ending
+    with slot t, run[t][k] = busy[t] and run[t-1][k-1].  Let P(i, t) be
+    the penalty of a stretch from slot i to t.  A stretch which started
+    in slot i has grown by P(i, t) - P(i, t-1) in slot t.  Summing this
+    over the starts i (run[t][k] and not run[t][k+1]) and regrouping by
+    run[t][k] makes the coefficient of run[t][k] a second difference of
+    P.  That is zero where the penalty is linear in the stretch length,
+    so only as many levels k are made as the penalty bends for.
+    """
+    objective = list()
+    correction = 0
+    for day in range(7):
+      day_slots = self.spec.slots_by_day[day]
+      # coefficients[t][k-1] is the coefficient of run[t][k].
+      coefficients = []
+      for t in range(len(day_slots)):
+        coefficients.append([])
+        previous_growth = 0
+        for k in range(1, t + 2):
+          # The slots of a day are numbered consecutively.
+          growth = self.NoBreakRunPenalty(day_slots[t-k+1], day_slots[t])
+          if k > 1:
+            growth -= self.NoBreakRunPenalty(day_slots[t-k+1], day_slots[t-1])
+          coefficients[t].append(growth - previous_growth)
+          previous_growth = growth
+      # The number of levels needed at t, for its own terms or for the
+      # chains of the following slots.
+      depth = [0] * (len(day_slots) + 1)
+      for t in reversed(range(len(day_slots))):
+        depth[t] = max(0, depth[t+1] - 1)
+        for k in range(len(coefficients[t]), depth[t], -1):
+          if coefficients[t][k-1]:
+            depth[t] = k
+            break
+      # The runs as literals, or True or False if fixed.
+      previous_runs = []
+      for t, slot in enumerate(day_slots):
+        busy = self.Busy(slot)
+        runs = [busy]
+        for k in range(2, depth[t] + 1):
+          runs.append(self.And(busy, previous_runs[k-2]))
+        for k in range(1, depth[t] + 1):
+          (actual_penalty, term) = self.MakeLiteralTerm(
+              coefficients[t][k-1], runs[k-1])
+          if term is not None:
+            objective.append(term)
+          else:
+            correction += actual_penalty
+        previous_runs = runs
+    return (objective, correction)
+
+  def MakeLiteralTerm(self, penalty, value):
+    """Like MakeProd, for value a literal or True or False."""
+    if penalty == 0 or value is False:
+      return (0, None)
+    if value is True:
+      return (penalty, None)
+    return (penalty, self.model.MakeTerm(penalty, (value,)))
+
+  def Busy(self, slot):
+    """Whether the instructor is busy in slot, a literal or True or False."""
+    if self.var_id[0][slot] >= 0:
+      return self.var_id[0][slot]
+    return self.fixed_value[0][slot] == 1
+
+  def Free(self, slot):
+    busy = self.Busy(slot)
+    if busy is True or busy is False:
+      return not busy
+    return -busy
+
+  def FreeChain(self, slots, all_free=None):
+    """Whether the instructor is free for all of the first j+1 slots.
+
+    Returns a list of literals or True or False, made as a chain of
+    products.  all_free, if given, is used for the last one.
+    """
+    chain = []
+    for index, slot in enumerate(slots):
+      if all_free is not None and index == len(slots) - 1:
+        chain.append(all_free)
+      elif not chain:
+        chain.append(self.Free(slot))
+      else:
+        chain.append(self.And(chain[-1], self.Free(slot)))
+    return chain
+
+  def DayOff(self, day):
+    """Whether the instructor has day off, shared by the bonuses."""
+    if day not in self.day_off:
+      self.day_off[day] = self.FreeChain(self.spec.slots_by_day[day])
+    return self.day_off[day][-1]
+
+  def And(self, a, b):
+    """a and b, each a literal or True or False."""
+    if a is False or b is False:
+      return False
+    if a is True:
+      return b
+    if b is True:
+      return a
+    return self.MakeProductVariable(sorted([a, b], key=abs))
 
   def MakeDayOffBonus(self):
     """Assign a bonus for missing the entire day."""
@@ -678,236 +1338,516 @@ class Scheduler:
       workday_time = self.spec.day_range[day][1] - self.spec.day_range[day][0]
       bonus = self.day_off_bonus * workday_time
 
-      (actual_penalty, term) = self.MakeProd(
-          -bonus, self.spec.slots_by_day[day], 0, 1)
-      if term:
+      if settings.SOLVER_DAY_BONUS_ENCODING == 'products':
+        (actual_penalty, term) = self.MakeProd(
+            -bonus, self.spec.slots_by_day[day], 0, 1)
+      else:
+        (actual_penalty, term) = self.MakeLiteralTerm(
+            -bonus, self.DayOff(day))
+      if term is not None:
         objective.append(term)
       else:
         correction += actual_penalty
     self.all_objectives['day off'] = (objective, correction)
-    self.objective.extend(objective)
-
-  def WriteFile(self):
-    self.header = (
-        '* #variable= '+str(self.next_var - 1)+
-        ' #constraint= '+str(len(self.constraints))+
-        ' #product= '+str(len(self.all_products))+
-        ' sizeproduct= '+str(self.max_product_size))
-    (handle_int, self.opb_file) = tempfile.mkstemp()
-    handle = os.fdopen(handle_int, 'w')
-    handle.write(self.header + '\n')
-    handle.write('min: ' + ' '.join(self.objective) + ';\n')
-    handle.write('\n'.join(self.constraints) + '\n')
-    handle.close()
+    self.model.objective.extend(objective)
+
+  def WriteFile(self, file_name):
+    """Write the model to an OPB file (for debugging)."""
+    with open(file_name, 'w') as handle:
+      handle.writelines(self.model.OpbLines())
 
   def Solve(self):
-    self.WriteFile()
-    time_limit = 60
-    total_time_limit = 600
+    self.Search()
+    with TimePhase(self.solver_run, 'ParseSolverOutput'):
+      return self.ParseSolverOutput()
+
+  def Search(self, time_limit=60, total_time_limit=600):
+    """Run the solver with threads from the budget, without parsing."""
+    if self.thread_budget:
+      threads = self.thread_budget.Acquire(self.model.num_variables)
+    else:
+      threads = settings.SOLVER_MAX_THREADS
+    try:
+      self.RunSolver(threads, time_limit, total_time_limit)
+    finally:
+      if self.thread_budget:
+        self.thread_budget.Release(threads)
+
+  def RunSolver(self, threads, time_limit=60, total_time_limit=600):
+    self.header = self.model.Header()
+    if settings.SOLVER_OPB_DUMP_DIR:
+      self.opb_file = os.path.join(
+          settings.SOLVER_OPB_DUMP_DIR,
+          'solver_run_' + str(self.solver_run.id) + '.opb')
+      with TimePhase(self.solver_run, 'WriteFile'):
+        self.WriteFile(self.opb_file)
     self.solver_run.scheduler_output += (
         ('Solving with a time limit of ' + str(time_limit) +
         ' seconds of not improving the solution or a total time limit of ' +
-        str(total_time_limit) + ' seconds\n' + self.header))
-    p = subprocess.Popen(
-        ['clasp', '-t8', '--time-limit='+str(total_time_limit), self.opb_file],
-        bufsize=0,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    lines = []
+        str(total_time_limit) + ' seconds using ' + str(threads) +
+        ' threads\n'))
+    self.component_jobs = []
+    if settings.SOLVER_DECOMPOSE:
+      # At most one clasp job per thread of the budget.
+      self.component_jobs = self.ComponentJobs(threads)
+    with TimePhase(self.solver_run, 'StreamModel'):
+      if len(self.component_jobs) > 1:
+        processes = self.StartComponentJobs(threads, total_time_limit)
+      else:
+        self.component_jobs = []
+        processes = self.StartPortfolio(threads, total_time_limit)
+    with TimePhase(self.solver_run, 'solver'):
+      self.WaitForSolver(processes, time_limit)
+
+  def WaitForSolver(self, processes, time_limit):
+    """Log the output of the processes until they are done, then stop them.
+
+    Sets the solver_ result attributes.
+    """
+    self.solver_run.scheduler_output += self.header
     current_time = time.time()
     last_activity = current_time
     last_save = current_time
+    last_cancel_check = current_time
     self.solver_run.state = self.solver_run.RUNNING
     self.solver_run.save()
 
-    poll_obj = select.poll()
-    poll_obj.register(p.stdout, select.POLLIN)   
-    output = []
-    chars = []
-    while p.poll() == None and current_time - last_activity <= time_limit:
-      if poll_obj.poll(0):
-        last_activity = time.time()
-        char = p.stdout.read(1).decode('ascii')
-        output.append(char)
-        if char == '\n':
-          line = ''.join(chars) + '\n'
-          m = re.match(r'^o (-?\d+)$', line)
-          if m:
-            last_save = current_time
-            self.solver_run.score = -(int(m.group(1)) + self.total_correction)
-            self.solver_run.solution = self.solver_run.SOLUTION
-            self.solver_run.solver_output = ''.join(output)
-            self.solver_run.save()
-          chars = []
-        else:
-          chars.append(char)
-      else:
-        if current_time - last_save > 1.0:
-          last_save = current_time
-          self.solver_run.solver_output = ''.join(output)
-          self.solver_run.save()
-        time.sleep(.1)
+    best_objective = None
+    # Improving models are saved as schedules, at most one per interval.
+    save_interval = settings.SOLVER_SCHEDULE_SAVE_INTERVAL
+    saved_score = self.solver_run.score
+    last_schedule_save = None
+    num_models = 0
+    running = list(processes)
+    while running and current_time - last_activity <= time_limit:
+      # Sleep in select until there is output, the next periodic save or
+      # cancel check is due or we have gone time_limit seconds without
+      # output.
+      deadline = min(last_activity + time_limit, last_cancel_check + 1.0)
+      if any([process.HasUnloggedOutput() for process in processes]):
+        deadline = min(deadline, last_save + 1.0)
+      if (save_interval is not None and last_schedule_save is not None and
+          sum([process.num_models for process in processes]) > num_models):
+        deadline = min(deadline, last_schedule_save + save_interval)
+      (ready, unused_write, unused_error) = select.select(
+          running, [], [], max(0.0, deadline - current_time))
       current_time = time.time()
-    if p.poll() == None:
-      p.terminate()
-    while p.poll() == None and poll_obj.poll(0):
-      output.append(p.stdout.read(1).decode('ascii'))
-
-    (remaining_output, unused_stderr) = p.communicate()
-    remaining_output = remaining_output.decode('ascii')
-    output.append(remaining_output)
-    self.solver_run.solver_output = ''.join(output)
-    self.solver_run.score = None
-    for line in self.solver_run.solver_output.splitlines():
-      m = re.match(r'^\s*c\s+optimization\s*:\s*(-?\d+)\s*$',
-                   line.strip().lower())
-      if m:
-        self.solver_run.score = -(int(m.group(1)) + self.total_correction)
-    self.solver_run.save()
-    return self.ParseSolverOutput()
+      improved = False
+      for process in ready:
+        (chunk, lines) = process.reader.ReadReady()
+        if chunk:
+          last_activity = current_time
+        if process.reader.eof:
+          running.remove(process)
+        if process.ProcessLines(lines):
+          objective = self.CombinedObjective(processes)
+          if (objective is not None and
+              (best_objective is None or objective < best_objective)):
+            best_objective = objective
+            improved = True
+      if improved:
+        self.solver_run.score = -(best_objective + self.total_correction)
+        self.solver_run.solution = self.solver_run.SOLUTION
+      if improved or current_time - last_save > 1.0:
+        last_save = current_time
+        self.LogSolverOutput(processes)
+        if improved:
+          self.solver_run.save(update_fields=['score', 'solution'])
+      if (save_interval is not None and
+          sum([process.num_models for process in processes]) > num_models and
+          (last_schedule_save is None or
+           current_time - last_schedule_save >= save_interval)):
+        num_models = sum([process.num_models for process in processes])
+        last_schedule_save = current_time
+        saved_score = self.SaveBestModel(processes, saved_score)
+      if current_time - last_cancel_check >= 1.0:
+        last_cancel_check = current_time
+        if CancelRequested(self.solver_run):
+          # Stopping clasp makes it print its best model, which is the
+          # result.
+          self.solver_run.scheduler_output += '\nStopped by the user.'
+          break
+      if self.component_jobs:
+        # Done when every component is solved, or one is impossible.
+        if (all([process.Finished() for process in processes]) or
+            any([process.status == 'UNSATISFIABLE' for process in processes])):
+          break
+      elif any([process.Finished() for process in processes]):
+        # Optimality (or impossibility) is proven, the rest can stop.
+        break
+    for process in processes:
+      process.Stop()
+    self.LogSolverOutput(processes)
+
+    if self.component_jobs:
+      self.MergeComponentResults(processes)
+    else:
+      # The process which proved its result, else the one with the best
+      # model.
+      finished = [process for process in processes if process.Finished()]
+      if finished:
+        winner = finished[0]
+      else:
+        winner = min(processes, key=lambda process: (
+            process.objective is None, process.objective or 0))
+      if len(processes) > 1:
+        self.solver_run.scheduler_output += (
+            '\nUsing the result of portfolio member ' + winner.name)
+      self.UseResult(winner)
+    # Without a result the score of an earlier schedule (if any) stands.
+    if self.solver_objective is not None:
+      self.solver_run.score = -(self.solver_objective + self.total_correction)
+    self.solver_run.save(update_fields=['score'])
+
+  def BestModel(self, processes):
+    """The values of the best model found so far, or None.
+
+    That is the best portfolio member's, or the combination of the
+    component jobs' once each of them has a model.
+    """
+    models = [process.LastModel() for process in processes]
+    if self.component_jobs:
+      if None in models:
+        return None
+      return self.MergeComponentValues(models)
+    models = [values for values in models if values is not None]
+    if not models:
+      return None
+    return min(models, key=lambda values: pbmodel.EvaluateTerms(
+        self.model.objective, values))
+
+  def SaveBestModel(self, processes, saved_score):
+    """Save the schedule of the best model found, if better than saved_score.
+
+    Returns the score of the best schedule saved.
+    """
+    values = self.BestModel(processes)
+    if values is None:
+      return saved_score
+    score = -(pbmodel.EvaluateTerms(self.model.objective, values) +
+              self.total_correction)
+    if saved_score is not None and score <= saved_score:
+      return saved_score
+    self.x_solution = values
+    self.SaveSchedule(self.TrueVariables(values), score)
+    return score
+
+  def UseResult(self, process):
+    """Take the result of the search from process."""
+    self.solver_status = process.status
+    self.solver_values = process.Assignment()
+    self.solver_objective = None
+    if self.solver_values is not None:
+      self.solver_objective = process.objective
+
+  def StartSolver(self, name, model, threads, total_time_limit,
+                  configuration=None, seed=None, variables=None):
+    """Start the SOLVER_BACKEND solver on model.
+
+    variables are the variables of the whole model making up model, if it
+    is a part of it.
+    """
+    if settings.SOLVER_BACKEND == 'replay':
+      return backend.ReplayProcess(name, model, self.ReplayOutput(variables),
+                                   settings.SOLVER_REPLAY_INTERVAL)
+    assert settings.SOLVER_BACKEND == 'clasp', (
+        'Unknown solver backend ' + settings.SOLVER_BACKEND)
+    return backend.ClaspProcess(
+        name, model, threads, total_time_limit, configuration, seed,
+        all_models=settings.SOLVER_SCHEDULE_SAVE_INTERVAL is not None)
+
+  def ReplayOutput(self, variables=None):
+    """The output for the replay backend to replay.
+
+    That is SOLVER_REPLAY_FILE, else the solution the objective was
+    bounded by (the greedy search fails with the bound in the model) or
+    else a greedy schedule, of the part of the model with the variables.
+    """
+    if settings.SOLVER_REPLAY_FILE:
+      with open(settings.SOLVER_REPLAY_FILE) as handle:
+        return handle.read()
+    if self.replay_values is None:
+      self.replay_values = self.start_values
+    if self.replay_values is None:
+      self.replay_values = greedy.GreedyScheduler(
+          self, settings.SOLVER_GREEDY_TIME_LIMIT).Run()
+    if self.replay_values is None:
+      return backend.ClaspOutput('UNKNOWN')
+    objective = self.model.objective
+    if variables is None:
+      variables = range(1, self.model.num_variables + 1)
+    else:
+      # Parts are closed under the objective's terms.
+      part = set(variables)
+      objective = [term for term in objective
+                   if abs(term.literals[0]) in part]
+    values = [False] + [self.replay_values[var] for var in variables]
+    return backend.ClaspOutput(
+        'SATISFIABLE', pbmodel.EvaluateTerms(objective, self.replay_values),
+        values)
+
+  def StartPortfolio(self, threads, total_time_limit):
+    portfolio_size = max(1, min(settings.SOLVER_PORTFOLIO_SIZE, threads))
+    processes = []
+    for index in range(portfolio_size):
+      if portfolio_size > 1:
+        configuration = backend.kPortfolioConfigurations[
+            index % len(backend.kPortfolioConfigurations)]
+        name = configuration + '/' + str(index)
+        process = self.StartSolver(
+            name, self.model, threads // portfolio_size, total_time_limit,
+            configuration=configuration, seed=index)
+        if process.args:
+          self.solver_run.scheduler_output += (
+              'Portfolio member ' + name + ': ' + ' '.join(process.args) +
+              '\n')
+      else:
+        process = self.StartSolver(
+            settings.SOLVER_BACKEND, self.model, threads, total_time_limit)
+      processes.append(process)
+    return processes
+
+  def ComponentJobs(self, max_jobs):
+    """Split the model into at most max_jobs independent parts.
+
+    Variables sharing a constraint or an objective term are in the same
+    component.  So pupils who could occlud a common slot are, and so are
+    the slots of a day if one of the day objectives is in use.  Components
+    are packed into jobs largest first, each into the smallest job so far.
+    Returns a list of sorted variable lists.
+    """
+    components = self.model.Components()
+    self.num_components = len(components)
+    jobs = [[] for _ in range(min(max_jobs, len(components)))]
+    for component in sorted(components, key=len, reverse=True):
+      min(jobs, key=len).extend(component)
+    return [sorted(job) for job in jobs]
+
+  def StartComponentJobs(self, threads, total_time_limit):
+    self.solver_run.scheduler_output += (
+        'Solving ' + str(self.num_components) + ' independent components ' +
+        'as ' + str(len(self.component_jobs)) + ' clasp jobs\n')
+    processes = []
+    for index in range(len(self.component_jobs)):
+      (submodel, unused_number) = self.model.Submodel(
+          self.component_jobs[index])
+      name = 'component ' + str(index)
+      self.solver_run.scheduler_output += (
+          name + ': ' + submodel.Header() + '\n')
+      processes.append(self.StartSolver(
+          name, submodel, max(1, threads // len(self.component_jobs)),
+          total_time_limit, variables=self.component_jobs[index]))
+    return processes
+
+  def CombinedObjective(self, processes):
+    """The objective value of the best model found so far, or None.
+
+    That is the best portfolio member's, or the sum over the component
+    jobs once each of them has a model.
+    """
+    objectives = [process.objective for process in processes]
+    if self.component_jobs:
+      if None in objectives:
+        return None
+      return sum(objectives)
+    objectives = [objective for objective in objectives
+                  if objective is not None]
+    if not objectives:
+      return None
+    return min(objectives)
+
+  def MergeComponentResults(self, processes):
+    """Combine the results of the component jobs into that of the model."""
+    statuses = [process.status for process in processes]
+    if 'UNSATISFIABLE' in statuses:
+      self.solver_status = 'UNSATISFIABLE'
+    elif all([process.Finished() for process in processes]):
+      self.solver_status = 'OPTIMUM FOUND'
+    elif all([status in ['SATISFIABLE', 'OPTIMUM FOUND']
+              for status in statuses]):
+      self.solver_status = 'SATISFIABLE'
+    else:
+      self.solver_status = 'UNKNOWN'
+    self.solver_objective = None
+    self.solver_values = None
+    if self.solver_status not in ['SATISFIABLE', 'OPTIMUM FOUND']:
+      return
+    self.solver_values = self.MergeComponentValues(
+        [process.Assignment() for process in processes])
+    self.solver_objective = self.CombinedObjective(processes)
+
+  def MergeComponentValues(self, models):
+    """The values of the model given those of each component job."""
+    values = array.array('b', [0]) * (self.model.num_variables + 1)
+    for component_values, variables in zip(models, self.component_jobs):
+      for index, var in enumerate(variables):
+        values[var] = component_values[index + 1]
+    return values
+
+  def LogSolverOutput(self, processes):
+    """Store the output of the portfolio that hasn't been stored yet."""
+    text = []
+    for process in processes:
+      prefix = ''
+      if len(processes) > 1:
+        prefix = process.name + ': '
+      for line in process.UnloggedLines():
+        text.append(prefix + line)
+    self.AppendSolverOutput(''.join(text))
+
+  def AppendSolverOutput(self, text):
+    """Store new solver output without rewriting what is already stored."""
+    if not text:
+      return
+    SolverOutputChunk.objects.create(
+        solver_run=self.solver_run, offset=self.solver_output_size, text=text)
+    self.solver_output_size += len(text)
 
   def PaddedSlotName(self, slot):
     slot_name = self.spec.slot_name[slot]
     return '%-6s' % slot_name
 
+  def ReadAssignment(self):
+    """Set x_solution from the solver's model, returns TrueVariables."""
+    # Indexed by solver variable number.
+    self.x_solution = self.solver_values
+    return self.TrueVariables(self.x_solution)
+
+  def TrueVariables(self, values):
+    """The true variables of lessons (or the instructor) in values."""
+    return [var for var in range(1, len(values))
+            if values[var] and self.var_pupil_slot[var] is not None]
+
+  def FixedLessons(self):
+    """The (pupil, slot) lessons fixed before solving, kept or presolved."""
+    return [(pupil, slot)
+            for pupil in range(1, self.spec.num_pupils)
+            for slot in range(self.spec.num_slots)
+            if self.fixed_value[pupil][slot] == 1]
+
+  def PupilLessons(self, true_vars):
+    """Pupil to lesson slots, for the fixed lessons and the true variables."""
+    lessons = dict()
+    for (pupil, slot) in (self.FixedLessons() +
+                          [self.var_pupil_slot[var] for var in true_vars]):
+      if pupil > 0:
+        lessons.setdefault(pupil, []).append(slot)
+    return lessons
+
   def ParseSolverOutput(self):
-    self.output_schedule = None
-    x_names = []
-    for line in self.solver_run.solver_output.splitlines():
-      m = re.match('^v(?:\s+-?x\d+)+$', line)
-      if m:
-        curr_vars = line.split(' ')
-        assert curr_vars[0] == 'v'
-        x_names.extend(curr_vars[1:])
-      m = re.match('^s (.*)$', line)
-      if m:
-        solution = m.group(1)
-        if solution == 'OPTIMUM FOUND':
-          self.solver_run.solution = self.solver_run.OPTIMAL
-        elif solution == 'UNSATISFIABLE':
-          self.solver_run.solution = self.solver_run.IMPOSSIBLE
-        elif solution == 'SATISFIABLE':
-          self.solver_run.solution = self.solver_run.SOLUTION
-        else:
-          assert False, 'Unable to parse solution line of clasp output.'
-      m = re.match('^s (.*)$', line)
-      if m:
-        solution = m.group(1)
-        if solution == 'OPTIMUM FOUND':
-          self.solver_run.solution = self.solver_run.OPTIMAL
-        elif solution == 'UNSATISFIABLE':
-          self.solver_run.solution = self.solver_run.IMPOSSIBLE
-        elif solution == 'SATISFIABLE':
-          self.solver_run.solution = self.solver_run.SOLUTION
-        elif solution == 'UNKNOWN':
-          self.solver_run.solution = self.solver_run.NO_SOLUTION
-        else:
-          assert False, 'Unable to parse solution line of clasp output.'
-      m = re.match('^o (-?\d+)$', line)
-      if m:
-        self.solver_run.score = -(int(m.group(1)) + self.total_correction)
+    """Record the result of the search, decoded as the output arrived."""
+    solution = self.solver_status
+    if solution == 'OPTIMUM FOUND':
+      self.solver_run.solution = self.solver_run.OPTIMAL
+    elif solution == 'UNSATISFIABLE':
+      self.solver_run.solution = self.solver_run.IMPOSSIBLE
+    elif solution == 'SATISFIABLE':
+      self.solver_run.solution = self.solver_run.SOLUTION
+    elif solution == 'UNKNOWN':
+      if self.solver_run.score is None:
+        self.solver_run.solution = self.solver_run.NO_SOLUTION
+      # Otherwise the schedule the run started from stands.
+    elif solution is not None:
+      assert False, 'Unable to parse solution line of clasp output.'
+    if self.solver_objective is not None:
+      self.solver_run.score = -(self.solver_objective + self.total_correction)
+
+    if self.solver_values is not None:
+      self.SaveResultSchedule(self.ReadAssignment())
+    self.solver_run.state = self.solver_run.DONE
+    self.solver_run.save()
+    return self.output_schedule
+
+  def SaveResultSchedule(self, true_vars):
+    """Save the schedule of the solver's model, unless saved while solving."""
+    if self.saved_score is None or self.solver_run.score != self.saved_score:
+      self.SaveSchedule(true_vars)
 
+  def SaveSchedule(self, true_vars, score=None):
+    """Save the schedule given by the true variables (and fixed lessons).
+
+    Its score is the run's unless given.
+    """
     text_schedule = 'Pupil Session Times.\n'
-    if (self.solver_run.solution in
-           [self.solver_run.SOLUTION, self.solver_run.OPTIMAL]):
-      self.x_solution = dict()
-      var_names = []
-      for x in x_names:
-        m = re.match('^(-)?(x\d+)$', x)
-        assert m
-        self.x_solution[m.group(2)] = not m.group(1)
-        if not m.group(1):
-          var_name = self.our_name[m.group(2)]
-          var_names.append(var_name)
-
-      self.solver_run.scheduler_output += '\n'
-
-      self.schedule = [None] * self.spec.num_slots
-      self.busy = [None] * self.spec.num_slots
-      pupil_schedule = dict()
-      for var_name in var_names:
-        m = re.match('^p(\d+)s(\d+)$', var_name)
-        assert m
-        pupil = int(m.group(1))
-        slot = int(m.group(2))
-        if pupil > 0:
-          self.schedule[slot] = pupil
-          if pupil not in pupil_schedule:
-            pupil_schedule[pupil] = [self.spec.slot_name[slot]]
-          else:
-            pupil_schedule[pupil].append(self.spec.slot_name[slot])
+    self.solver_run.scheduler_output += '\n'
+
+    self.schedule = [None] * self.spec.num_slots
+    self.busy = [None] * self.spec.num_slots
+    pupil_schedule = dict()
+    lessons = self.FixedLessons() + [
+        self.var_pupil_slot[var] for var in true_vars]
+    for (pupil, slot) in list(lessons):
+      if pupil > 0:
+        # The instructor is busy for the whole lesson (presolve may have
+        # replaced the instructor's variables by the pupil's).
+        for occlud in self.spec.pupil_slot_occlusion[pupil][slot]:
+          lessons.append((0, occlud))
+    for (pupil, slot) in lessons:
+      if pupil > 0:
+        self.schedule[slot] = pupil
+        if pupil not in pupil_schedule:
+          pupil_schedule[pupil] = [self.spec.slot_name[slot]]
         else:
-          self.busy[slot] = True
-      for pupil in range(1, self.spec.num_pupils):
-        text_schedule += (self.spec.pupil_name[pupil] + ' -- ' +
-                          ', '.join(pupil_schedule[pupil]) + '\n')
-      text_schedule += '\n\n'
-      text_schedule += 'Instructor Schedule.\n'
-      text_schedule += 'For reference the first column is the instructor preference value (i1, i2, i3, etc).\n'
-      text_schedule += 'The second column is the pupil preference value (p1, p2, p3, etc).\n'
-      text_schedule += 'The third column is the session time.\n'
-      text_schedule += 'And the fourth column is the pupil name.\n'
-      for day in range(7):
-        for slot in self.spec.slots_by_day[day]:
-          pupil = self.schedule[slot]
-          pref = self.spec.pupil_slot_preference[0][slot]
-          if pref >= 0:
-            instructor_preference = str(pref)
-          else:
-            instructor_preference = 'X'
-          extra = 'i' + instructor_preference + ' '
-          if pupil:
-            pupil_preference = str(self.spec.pupil_slot_preference[pupil][slot])
-            extra += 'p' + pupil_preference + ' '
+          pupil_schedule[pupil].append(self.spec.slot_name[slot])
+      else:
+        self.busy[slot] = True
+    for pupil in range(1, self.spec.num_pupils):
+      text_schedule += (self.spec.pupil_name[pupil] + ' -- ' +
+                        ', '.join(pupil_schedule[pupil]) + '\n')
+    text_schedule += '\n\n'
+    text_schedule += 'Instructor Schedule.\n'
+    text_schedule += 'For reference the first column is the instructor preference value (i1, i2, i3, etc).\n'
+    text_schedule += 'The second column is the pupil preference value (p1, p2, p3, etc).\n'
+    text_schedule += 'The third column is the session time.\n'
+    text_schedule += 'And the fourth column is the pupil name.\n'
+    for day in range(7):
+      for slot in self.spec.slots_by_day[day]:
+        pupil = self.schedule[slot]
+        pref = self.spec.pupil_slot_preference[0][slot]
+        if pref >= 0:
+          instructor_preference = str(pref)
+        else:
+          instructor_preference = 'X'
+        extra = 'i' + instructor_preference + ' '
+        if pupil:
+          pupil_preference = str(self.spec.pupil_slot_preference[pupil][slot])
+          extra += 'p' + pupil_preference + ' '
+          text_schedule += (
+              extra + self.PaddedSlotName(slot) + ' ' +
+              self.spec.pupil_name[pupil] + '\n')
+        else:
+          extra += '   '
+          if self.busy[slot]:
             text_schedule += (
-                extra + self.PaddedSlotName(slot) + ' ' +
-                self.spec.pupil_name[pupil] + '\n')
+                extra + self.PaddedSlotName(slot) + ' ---Lesson Ongoing---\n')
           else:
-            extra += '   '
-            if self.busy[slot]:
+            if self.spec.pupil_slot_preference[0][slot] > 0:
               text_schedule += (
-                  extra + self.PaddedSlotName(slot) + ' ---Lesson Ongoing---\n')
+                  extra + self.PaddedSlotName(slot) + '\n')
             else:
-              if self.spec.pupil_slot_preference[0][slot] > 0:
+              if instructor_preference == 'X':
                 text_schedule += (
-                    extra + self.PaddedSlotName(slot) + '\n')
+                    extra + self.PaddedSlotName(slot) + ' ***Forced to be Busy***\n')
               else:
-                if instructor_preference == 'X':
-                  text_schedule += (
-                      extra + self.PaddedSlotName(slot) + ' ***Forced to be Busy***\n')
-                else:
-                  text_schedule += (
-                      extra + self.PaddedSlotName(slot) + ' ***Forced to be Free***\n')
-        text_schedule += '\n'
-      self.EvaluateAllObjectives()
-      self.output_schedule = Schedule()
-      self.output_schedule.score = self.solver_run.score
-      self.output_schedule.schedule = text_schedule
-      self.output_schedule.created_by = self.solver_run
-      self.output_schedule.save()
-    self.solver_run.state = self.solver_run.DONE
-    self.solver_run.save()
+                text_schedule += (
+                    extra + self.PaddedSlotName(slot) + ' ***Forced to be Free***\n')
+      text_schedule += '\n'
+    self.EvaluateAllObjectives()
+    self.output_schedule = Schedule()
+    if score is None:
+      score = self.solver_run.score
+    self.output_schedule.score = score
+    self.output_schedule.schedule = text_schedule
+    self.output_schedule.assignment = repr(dict(
+        [(self.spec.pupil_name[pupil], slot_names)
+         for pupil, slot_names in sorted(pupil_schedule.items())]))
+    self.output_schedule.created_by = self.solver_run
+    self.output_schedule.save()
+    self.saved_score = score
     return self.output_schedule
 
   def EvaluateObjective(self, objective):
-    total_penalty = 0
-    for term in objective:
-      m = re.match(r'^ *((?:-|\+)\d+)((?: +~?x\d+)+) *$', term)
-      assert m, 'failed to parse: ' + term
-      penalty = int(m.group(1))
-      apply_penalty = True
-      for x in m.group(2).split():
-        x = x.strip()
-        neg = False
-        if x[0] == '~':
-          neg = True
-          x = x[1:]
-        in_solution = self.x_solution[x]
-        if in_solution == neg:
-          apply_penalty = False
-          break
-      if apply_penalty:
-        total_penalty += penalty
-    return total_penalty
+    return pbmodel.EvaluateTerms(objective, self.x_solution)
 
   def EvaluateAllObjectives(self):
     total_penalty = 0
@@ -925,29 +1865,257 @@ class Scheduler:
         ' for term \"' + name + '\" (' + str(total_penalty) + ' + ' +
         str(total_correction) + ')\n')
 
-def ExecuteSolverRun(solver_run):
-  try:
-    # Run the solver on the data.
-    parser = csv.reader(solver_run.availability.csv_data.splitlines(True))
-    table_data = []
-    for row in parser:
-      if not row:
-        continue
-      table_data.append([x.strip() for x in row])
 
-    constraints = Constraints(
-        default_length=solver_run.availability.default_length)
-    constraints.ParseIterator(table_data)
+class NeighborhoodSearch:
+  """Large neighborhood search, for problems too big to solve in one go.
+
+  Starting from a schedule, repeatedly free the lessons of a few pupils
+  (chosen at random, or among those with a lesson on a random day), fix
+  all the other lessons and have the solver look for a strictly better
+  schedule of the small problem that is left.  Improvements are kept and
+  their scores streamed to the SolverRun as Solve does.
+  """
+
+  def __init__(self, spec, solver_run, thread_budget=None):
+    self.spec = spec
+    self.solver_run = solver_run
+    self.thread_budget = thread_budget
+    self.start_time = time.time()
+    self.random = random.Random(solver_run.id)
+    self.lessons = None  # Pupil to lesson slots of the current schedule.
+    self.score = None
+    self.solver_output_size = 0
+
+  def Start(self, schedule=None):
+    """Find the schedule to start from.
+
+    This is schedule if it is a solution of the problem, otherwise the
+    whole problem is solved until it stops improving for a subproblem time
+    limit.  Returns False if that already completed the run.
+    """
+    full = Scheduler(self.spec, self.solver_run, self.thread_budget)
+    full.Prepare()
+    values = None
+    if schedule is not None:
+      values = full.AssignmentFromSchedule(schedule)
+    if values is not None:
+      if not self.solver_run.schedule_set.filter(
+          score__gte=schedule.score).exists():
+        full.CopySchedule(schedule)
+      self.solver_run.scheduler_output += (
+          'Neighborhood search starting from schedule ' + str(schedule.id) +
+          '.\n')
+    else:
+      values = full.SaveGreedySchedule()
+      if values is not None:
+        self.solver_run.scheduler_output += (
+            'Neighborhood search starting from the provisional schedule.\n')
+    if values is not None:
+      self.lessons = full.PupilLessons(
+          full.TrueVariables(values))
+      self.score = -(pbmodel.EvaluateTerms(full.model.objective, values) +
+                     full.total_correction)
+      self.solver_run.score = self.score
+      self.solver_run.solution = SolverRun.SOLUTION
+      self.solver_run.save()
+      return True
+
+    self.solver_run.scheduler_output += (
+        'Neighborhood search starting from a solution of the whole '
+        'problem.\n')
+    time_limit = settings.SOLVER_LNS_SUBPROBLEM_TIME_LIMIT
+    full.Search(time_limit, settings.SOLVER_LNS_TIME_LIMIT)
+    self.solver_output_size = full.solver_output_size
+    if full.solver_status != 'SATISFIABLE':
+      # Proven optimal or impossible, or no solution at all.
+      full.ParseSolverOutput()
+      return False
+    true_vars = full.ReadAssignment()
+    self.lessons = full.PupilLessons(true_vars)
+    self.score = self.solver_run.score
+    full.SaveResultSchedule(true_vars)
+    return True
+
+  def ChooseNeighborhood(self, iteration):
+    """Returns (pupils to free, description), alternating pupils and days."""
+    size = settings.SOLVER_LNS_NEIGHBORHOOD_SIZE
+    pupils = sorted(self.lessons)
+    description = 'random pupils'
+    if iteration % 2:
+      day = self.random.choice(
+          [day for day in range(7) if self.spec.slots_by_day[day]])
+      slots = set(self.spec.slots_by_day[day])
+      pupils = [pupil for pupil in pupils if slots & set(self.lessons[pupil])]
+      description = 'pupils on day ' + 'MTWRFSU'[day]
+    if len(pupils) > size:
+      pupils = self.random.sample(pupils, size)
+    return (set(pupils), description)
+
+  def SolveNeighborhood(self, freed, time_limit):
+    """Re-solve the lessons of the freed pupils with the rest kept.
+
+    Returns the solver status of the subproblem.
+    """
+    sub = Scheduler(self.spec, self.solver_run, self.thread_budget)
+    sub.kept_lessons = dict([(pupil, slots)
+                             for pupil, slots in self.lessons.items()
+                             if pupil not in freed])
+    sub.solver_output_size = self.solver_output_size
+    sub.Prepare()
+    # Only strictly better schedules are of interest.
+    sub.BoundObjective(-self.score - sub.total_correction - 1)
+    sub.Search(time_limit, time_limit)
+    self.solver_output_size = sub.solver_output_size
+    if sub.solver_status in ['SATISFIABLE', 'OPTIMUM FOUND']:
+      true_vars = sub.ReadAssignment()
+      self.lessons = sub.PupilLessons(true_vars)
+      self.score = -(sub.EvaluateObjective(sub.model.objective) +
+                     sub.total_correction)
+      self.solver_run.score = self.score
+      sub.SaveResultSchedule(true_vars)
+    return sub.solver_status
+
+  def Run(self):
+    iteration = 0
+    while True:
+      remaining = settings.SOLVER_LNS_TIME_LIMIT - (
+          time.time() - self.start_time)
+      if remaining < 1 or CancelRequested(self.solver_run):
+        break
+      (freed, description) = self.ChooseNeighborhood(iteration)
+      score = self.score
+      status = self.SolveNeighborhood(freed, int(min(
+          remaining, settings.SOLVER_LNS_SUBPROBLEM_TIME_LIMIT)))
+      if not self.solver_run.scheduler_output.endswith('\n'):
+        # The solver's header line.
+        self.solver_run.scheduler_output += '\n'
+      self.solver_run.scheduler_output += (
+          'Neighborhood ' + str(iteration) + ' (' + str(len(freed)) + ' ' +
+          description + '): score ' + str(score) + ' -> ' +
+          str(self.score) + '\n')
+      iteration += 1
+      if (len(freed) == len(self.lessons) and
+          status in ['OPTIMUM FOUND', 'UNSATISFIABLE']):
+        # Nothing was kept, so this is the best schedule there is.
+        self.solver_run.solution = SolverRun.OPTIMAL
+        break
+    self.solver_run.score = self.score
+    self.solver_run.state = SolverRun.DONE
+    self.solver_run.save()
 
-    scheduler = Scheduler(constraints, solver_run)
+def ClaimSolverRun():
+  """Take the oldest queued SolverRun for this worker.
+
+  The run is moved to RUNNING with a conditional update, so when several
+  workers race for the same run only one of them gets it.  Returns None
+  if the queue is empty.
+  """
+  while True:
+    queued = list(SolverRun.objects.filter(
+        state=SolverRun.IN_QUEUE).order_by('creation_time').values_list(
+            'id', flat=True)[:10])
+    if not queued:
+      return None
+    for solver_run_id in queued:
+      if SolverRun.objects.filter(
+          pk=solver_run_id, state=SolverRun.IN_QUEUE).update(
+              state=SolverRun.RUNNING):
+        return SolverRun.objects.get(pk=solver_run_id)
+
+def ParseAvailability(availability):
+  parser = csv.reader(availability.csv_data.splitlines(True))
+  table_data = []
+  for row in parser:
+    if not row:
+      continue
+    table_data.append([x.strip() for x in row])
+
+  constraints = Constraints(default_length=availability.default_length)
+  constraints.ParseIterator(table_data)
+  return constraints
+
+def BestSchedule(availability):
+  """The best schedule found so far for availability, to warm start from."""
+  return Schedule.objects.filter(
+      deleted=False, score__isnull=False,
+      created_by__availability=availability).exclude(
+          assignment='').order_by('-score').first()
+
+def ExecuteSolverRun(solver_run, thread_budget=None):
+  start_time = time.time()
+  start_cpu = CpuTime()
+  try:
+    # Run the solver on the data.
+    with TimePhase(solver_run, 'ParseAvailability'):
+      constraints = ParseAvailability(solver_run.availability)
+
+    scheduler = Scheduler(constraints, solver_run, thread_budget)
+    if scheduler.UseCachedResult():
+      return True
+    with TimePhase(solver_run, 'CheckLessonCapacity'):
+      explanation = scheduler.CheckLessonCapacity()
+    if explanation:
+      solver_run.scheduler_output += explanation
+      solver_run.solution = SolverRun.IMPOSSIBLE
+      solver_run.state = SolverRun.DONE
+      solver_run.save()
+      return True
+    if constraints.num_pupils - 1 >= settings.SOLVER_LNS_MIN_PUPILS:
+      search = NeighborhoodSearch(constraints, solver_run, thread_budget)
+      with TimePhase(solver_run, 'NeighborhoodSearch'):
+        if search.Start(solver_run.warm_start or
+                        BestSchedule(solver_run.availability)):
+          search.Run()
+      return True
+    parent = solver_run.availability.parent
+    parent_schedule = None
+    if parent and not solver_run.warm_start:
+      parent_schedule = BestSchedule(parent)
+    if parent_schedule:
+      with TimePhase(solver_run, 'KeepUnaffectedLessons'):
+        num_kept = scheduler.KeepUnaffectedLessons(
+            ParseAvailability(parent), parent_schedule)
+      solver_run.scheduler_output += (
+          'Incremental solve keeping the lessons of ' + str(num_kept) +
+          ' pupils from schedule ' + str(parent_schedule.id) + '.\n')
     scheduler.Prepare()
+    if solver_run.warm_start:
+      with TimePhase(solver_run, 'AddWarmStart'):
+        scheduler.AddWarmStart(solver_run.warm_start)
+    elif scheduler.cached_schedule:
+      # Only look for schedules at least as good as the copied one.
+      with TimePhase(solver_run, 'AddWarmStart'):
+        if not scheduler.AddWarmStart(scheduler.cached_schedule, copy=False):
+          scheduler.AddGreedyStart()
+    else:
+      with TimePhase(solver_run, 'AddGreedyStart'):
+        scheduler.AddGreedyStart()
     scheduler.Solve()
+    if scheduler.kept_lessons and solver_run.solution == SolverRun.OPTIMAL:
+      # Only optimal given the kept lessons.
+      solver_run.solution = SolverRun.SOLUTION
+      solver_run.save(update_fields=['solution'])
+    if scheduler.kept_lessons and solver_run.solution == SolverRun.IMPOSSIBLE:
+      solver_run.scheduler_output += (
+          'The incremental problem is impossible, solving the whole '
+          'problem.\n')
+      solver_run.solution = SolverRun.NO_SOLUTION
+      solver_output_size = scheduler.solver_output_size
+      scheduler = Scheduler(constraints, solver_run, thread_budget)
+      scheduler.solver_output_size = solver_output_size
+      scheduler.Prepare()
+      scheduler.Solve()
     return True
   except:
     logger.error(traceback.format_exc())
     solver_run.state = SolverRun.FAILED
     solver_run.save()
     return False
+  finally:
+    solver_run.AddPhaseTime('total', time.time() - start_time,
+                            CpuTime() - start_cpu)
+    if solver_run.pk:
+      solver_run.save(update_fields=['phase_times', 'model_size'])
 
 def RunSolve(availability_id, solver_options_id):
   availability = Availability.objects.get(pk=availability_id)
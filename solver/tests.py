@@ -1,3 +1,373 @@
+import ast
+import contextlib
+import csv
+import io
+import os
+import random
+
 from django.test import TestCase
+from django.core.urlresolvers import reverse
+
+from scheduler import settings
+from solver.models import Availability, Schedule, SolverOptions, SolverRun
+from solver import backend
+from solver import pbmodel
+from solver import solver
+
+kOptions = {
+    'arrive_late_bonus': 310,
+    'leave_early_bonus': 320,
+    'day_off_bonus': 500,
+    'no_break_penalty': repr({0: 660, 60: 0, 90: 100, 120: 200, 150: 400}),
+    'pupil_preference_penalty_list': '100,201,403,807',
+    'instructor_preference_penalty_list': '305,620,1290,2600',
+    'complex_constraints': '',
+}
+
+
+def MakeRows(days, pupils, start=9*60, end=12*60):
+  """A CSV table (as rows) with 30 minute slots from start to end each day.
+
+  pupils maps the pupil names to the days they are available on (always
+  with preference 1).  The instructor is available every slot.
+  """
+  header = ['Schedule']
+  slot_days = []
+  for day in days:
+    for minutes in range(start, end + 1, 30):
+      header.append(day + ' ' + str(minutes // 60) + ':%02d' % (minutes % 60))
+      slot_days.append((day, minutes < end))
+  rows = [header,
+          ['Instructor1'] + ['1' if available else ''
+                             for (unused_day, available) in slot_days]]
+  for name, pupil_days in sorted(pupils.items()):
+    rows.append([name] + ['1' if day in pupil_days and available else ''
+                          for (day, available) in slot_days])
+  return rows
+
+
+def MakeRun(rows, parent=None, warm_start=None, **options):
+  """A saved SolverRun of the table, as claimed by a worker."""
+  solver_options = dict(kOptions)
+  solver_options.update(options)
+  solver_options = SolverOptions(**solver_options)
+  solver_options.save()
+  csv_data = io.StringIO()
+  csv.writer(csv_data).writerows(rows)
+  availability = Availability(csv_data=csv_data.getvalue(),
+                              default_length=30, parent=parent)
+  availability.save()
+  solver_run = SolverRun(options=solver_options, availability=availability,
+                         solver_version=solver.version_number,
+                         warm_start=warm_start, state=SolverRun.RUNNING,
+                         solution=SolverRun.NO_SOLUTION)
+  solver_run.save()
+  return solver_run
+
+
+def MakeScheduler(rows, **options):
+  """A Scheduler (not prepared) of the table, with a saved SolverRun."""
+  solver_run = MakeRun(rows, **options)
+  return solver.Scheduler(solver.ParseAvailability(solver_run.availability),
+                          solver_run)
+
+
+@contextlib.contextmanager
+def Settings(**values):
+  """Change scheduler.settings for the duration of the block."""
+  old_values = dict([(name, getattr(settings, name)) for name in values])
+  for name, value in values.items():
+    setattr(settings, name, value)
+  try:
+    yield
+  finally:
+    for name, value in old_values.items():
+      setattr(settings, name, value)
+
+
+def InstructorValues(scheduler, busy):
+  """The assignment with the instructor busy in the slots busy.
+
+  The pupils have no lessons, which doesn't matter to the objectives
+  about the instructor's day.
+  """
+  values = [False] * (scheduler.model.num_variables + 1)
+  for slot in busy:
+    if scheduler.var_id[0][slot] >= 0:
+      values[scheduler.var_id[0][slot]] = True
+  pbmodel.SetDefinedVariables(scheduler.model, values)
+  return values
+
+
+class EncodingTest(TestCase):
+  """The encodings of an objective give every schedule the same value."""
+
+  def assertSameObjectives(self, names, setting, encodings):
+    rows = MakeRows('MTW', {'P1': 'MT', 'P2': 'TW', 'P3': 'W'},
+                    start=8*60, end=14*60)
+    schedulers = []
+    for encoding in encodings:
+      with Settings(SOLVER_PRESOLVE=False, **{setting: encoding}):
+        scheduler = MakeScheduler(rows)
+        scheduler.Prepare()
+        schedulers.append(scheduler)
+    slots = range(schedulers[0].spec.num_slots)
+    rand = random.Random(0)
+    for unused_trial in range(300):
+      # From mostly free to mostly busy days.
+      fraction = rand.random()
+      busy = [slot for slot in slots if rand.random() < fraction]
+      for name in names:
+        scores = []
+        for scheduler in schedulers:
+          (objective, correction) = scheduler.all_objectives[name]
+          scores.append(pbmodel.EvaluateTerms(
+              objective, InstructorValues(scheduler, busy)) + correction)
+        self.assertEqual(scores[0], scores[1], name + ' ' + str(busy))
+
+  def testNoBreakEncodings(self):
+    self.assertSameObjectives(['no break'], 'SOLVER_NO_BREAK_ENCODING',
+                              ['products', 'chains'])
+
+  def testDayBonusEncodings(self):
+    self.assertSameObjectives(['arrive late', 'leave early', 'day off'],
+                              'SOLVER_DAY_BONUS_ENCODING',
+                              ['products', 'chains'])
+
+
+def MakeModel(num_variables):
+  """A model with num_variables variables and their sum as objective."""
+  model = pbmodel.PseudoBooleanModel()
+  for unused_var in range(num_variables):
+    var = model.NewVariable()
+    model.objective.append(model.MakeTerm(1, (var,)))
+  return model
+
+
+class SolverProcessTest(TestCase):
+
+  def testLogsFinalModelBeforeStatus(self):
+    # As clasp prints it, every model's values before its objective.  The
+    # values of the final model are logged with the status.
+    process = backend.SolverProcess('test', MakeModel(3))
+    process.ProcessLines(['c Answer: 1', 'v x1 x2 -x3', 'o 2',
+                          'c Answer: 2', 'v -x1 x2 -x3', 'o 1',
+                          's OPTIMUM FOUND', 'c Optimization : 1'])
+    self.assertEqual(
+        ['c Answer: 1\n', 'o 2\n', 'c Answer: 2\n', 'o 1\n',
+         'v -x1 x2 -x3\n', 's OPTIMUM FOUND\n', 'c Optimization : 1\n'],
+        process.UnloggedLines())
+    self.assertEqual([0, 0, 1, 0], list(process.Assignment()))
+
+  def testLogsModelBeforeObjective(self):
+    process = backend.SolverProcess('test', MakeModel(3))
+    process.ProcessLines(['o 2', 'v x1 x2 -x3', 's SATISFIABLE'])
+    self.assertEqual(['o 2\n', 'v x1 x2 -x3\n', 's SATISFIABLE\n'],
+                     process.UnloggedLines())
+
+  def Feed(self, process, pieces):
+    """Give process the pieces of output as separate reads, then EOF."""
+    (read_fd, write_fd) = os.pipe()
+    with os.fdopen(read_fd, 'rb', 0) as handle:
+      process.reader = backend.LineReader(handle)
+      for piece in pieces + ['']:
+        if piece:
+          os.write(write_fd, piece.encode('ascii'))
+        else:
+          os.close(write_fd)
+        (unused_chunk, lines) = process.reader.ReadReady()
+        process.ProcessLines(lines)
+      self.assertTrue(process.reader.eof)
+
+  def testChunkedOutput(self):
+    rand = random.Random(0)
+    values = [False] + [rand.random() < 0.5 for unused_var in range(25)]
+    text = 'o 9\n' + backend.ClaspOutput('SATISFIABLE', 7, values)
+    for unused_trial in range(50):
+      # Splits inside lines, 'v' lines over several reads included.
+      offsets = sorted(rand.sample(range(1, len(text)), 4))
+      process = backend.SolverProcess('test', MakeModel(25))
+      self.Feed(process, [text[start:end] for start, end in
+                          zip([0] + offsets, offsets + [len(text)])])
+      self.assertEqual(7, process.objective)
+      self.assertEqual('SATISFIABLE', process.status)
+      self.assertEqual([int(value) for value in values],
+                       list(process.LastModel()))
+      self.assertEqual(text.splitlines(True), process.UnloggedLines())
+
+  def testOptimizationCommentOverridesObjective(self):
+    process = backend.SolverProcess('test', MakeModel(3))
+    self.Feed(process, ['o 5\nv x1 x2 x3\ns SATISFIABLE\n',
+                        'c Optimization : 3\n'])
+    self.assertEqual(3, process.objective)
+
+  def testEndInsideModel(self):
+    # Killed while printing a model, the last line without its newline.
+    process = backend.SolverProcess('test', MakeModel(3))
+    self.Feed(process, ['v -x1 x2 x3\no 2\nv x1 -x2', ' -x3'])
+    self.assertIsNone(process.status)
+    self.assertEqual(2, process.objective)
+    self.assertEqual([0, 1, 0, 0], list(process.LastModel()))
+    self.assertIsNone(process.Assignment())
+    self.assertEqual(['o 2\n', 'v x1 -x2 -x3\n'], process.UnloggedLines())
+
+
+class PresolveTest(TestCase):
+
+  def testSchedulesScoreTheSame(self):
+    rows = MakeRows('MT', {'P1': 'M', 'P2': 'M', 'P3': 'M', 'P4': 'T'})
+    # P1 can only have the first slot, which presolve fixes, and only P4
+    # can fill the instructor's slots on Tuesday, so those are replaced.
+    rows[2][2:] = [''] * (len(rows[2]) - 2)
+    schedulers = []
+    for presolve in [False, True]:
+      with Settings(SOLVER_PRESOLVE=presolve):
+        scheduler = MakeScheduler(rows)
+        scheduler.Prepare()
+        schedulers.append(scheduler)
+    (plain, presolved) = schedulers
+    self.assertLess(presolved.model.num_variables, plain.model.num_variables)
+    spec = plain.spec
+    choices = dict()
+    for pupil in range(1, spec.num_pupils):
+      choices[spec.pupil_name[pupil]] = [
+          spec.slot_name[slot] for slot in range(spec.num_slots)
+          if plain.var_id[pupil][slot] >= 0]
+    rand = random.Random(0)
+    num_solutions = 0
+    for unused_trial in range(300):
+      schedule = Schedule(assignment=repr(dict(
+          [(name, [rand.choice(slots)]) for name, slots in choices.items()])))
+      scores = []
+      for scheduler in schedulers:
+        values = scheduler.AssignmentFromSchedule(schedule)
+        if values is None:
+          scores.append(None)
+        else:
+          scores.append(pbmodel.EvaluateTerms(scheduler.model.objective,
+                                              values) +
+                        scheduler.total_correction)
+      self.assertEqual(scores[0], scores[1], schedule.assignment)
+      if scores[0] is not None:
+        num_solutions += 1
+    self.assertTrue(num_solutions)
+
+
+class ReplayTest(TestCase):
+  """Whole runs, with the replay backend in place of clasp."""
+
+  def setUp(self):
+    self.settings = Settings(SOLVER_BACKEND='replay', SOLVER_REPLAY_FILE=None,
+                             SOLVER_REPLAY_INTERVAL=0)
+    self.settings.__enter__()
+    self.rows = MakeRows('MT', {'P1': 'M', 'P2': 'MT', 'P3': 'T'})
+
+  def tearDown(self):
+    self.settings.__exit__(None, None, None)
+
+  def Execute(self, solver_run):
+    self.assertTrue(solver.ExecuteSolverRun(solver_run))
+    return SolverRun.objects.get(pk=solver_run.pk)
+
+  def MakeSchedule(self, rows, lessons):
+    """A saved schedule of the table with lessons (not made by a solver)."""
+    scheduler = MakeScheduler(rows)
+    scheduler.Prepare()
+    schedule = Schedule(schedule='', assignment=repr(lessons),
+                        created_by=scheduler.solver_run)
+    values = scheduler.AssignmentFromSchedule(schedule)
+    self.assertIsNotNone(values)
+    schedule.score = -(pbmodel.EvaluateTerms(scheduler.model.objective,
+                                             values) +
+                       scheduler.total_correction)
+    schedule.save()
+    return schedule
+
+  def Lessons(self, solver_run):
+    """The lessons of the best schedule of solver_run."""
+    return ast.literal_eval(
+        solver_run.schedule_set.order_by('-score').first().assignment)
+
+  def testIdenticalRunReusesSchedule(self):
+    first = self.Execute(MakeRun(self.rows))
+    # The replay backend doesn't prove optimality, so the second run
+    # starts from the first one's schedule and can't improve on it.
+    second = self.Execute(MakeRun(self.rows))
+    self.assertIn('Copied the schedule of solver run ' + str(first.id),
+                  second.scheduler_output)
+    self.assertEqual(first.score, second.score)
+    self.assertEqual([first.score],
+                     [schedule.score for schedule in second.schedule_set.all()])
+
+  def testWarmStart(self):
+    # Not the schedule the greedy search finds.
+    lessons = {'P1': ['M 10:00'], 'P2': ['T 10:00'], 'P3': ['T 11:00']}
+    schedule = self.MakeSchedule(self.rows, lessons)
+    solver_run = self.Execute(MakeRun(self.rows, warm_start=schedule))
+    self.assertIn('Warm starting from schedule ' + str(schedule.id),
+                  solver_run.scheduler_output)
+    self.assertEqual(schedule.score, solver_run.score)
+    self.assertEqual([lessons], [ast.literal_eval(schedule.assignment)
+                                 for schedule in solver_run.schedule_set.all()])
+
+  def testEditKeepsUnaffectedLessons(self):
+    rows = MakeRows('MT', {'P1': 'M', 'P2': 'M', 'P3': 'T'})
+    lessons = {'P1': ['M 11:00'], 'P2': ['M 10:00'], 'P3': ['T 10:00']}
+    parent = self.MakeSchedule(rows, lessons)
+    # P3 can't come on Tuesday at 10:00 any more, which doesn't affect the
+    # pupils on Monday.
+    edited = [list(row) for row in rows]
+    edited[4][rows[0].index('T 10:00')] = ''
+    solver_run = self.Execute(
+        MakeRun(edited, parent=parent.created_by.availability))
+    self.assertIn('Incremental solve keeping the lessons of 2 pupils',
+                  solver_run.scheduler_output)
+    new_lessons = self.Lessons(solver_run)
+    self.assertEqual(lessons['P1'], new_lessons['P1'])
+    self.assertEqual(lessons['P2'], new_lessons['P2'])
+    self.assertNotEqual(lessons['P3'], new_lessons['P3'])
+
+  def testNeighborhoodSearchOnlyImproves(self):
+    lessons = {'P1': ['M 10:00'], 'P2': ['T 10:00'], 'P3': ['T 11:00']}
+    schedule = self.MakeSchedule(self.rows, lessons)
+    with Settings(SOLVER_LNS_MIN_PUPILS=3, SOLVER_LNS_NEIGHBORHOOD_SIZE=2,
+                  SOLVER_LNS_SUBPROBLEM_TIME_LIMIT=1, SOLVER_LNS_TIME_LIMIT=3):
+      solver_run = self.Execute(MakeRun(self.rows, warm_start=schedule))
+    self.assertIn('Neighborhood 0 ', solver_run.scheduler_output)
+    scores = [schedule.score
+              for schedule in solver_run.schedule_set.order_by('id')]
+    self.assertEqual(schedule.score, scores[0])
+    self.assertEqual(sorted(set(scores)), scores)
+    self.assertEqual(scores[-1], solver_run.score)
+
+
+class DecompositionTest(TestCase):
+
+  def testGreedyStartKeepsComponentsApart(self):
+    scheduler = MakeScheduler(MakeRows(
+        'MT', {'P1': 'M', 'P2': 'M', 'P3': 'T', 'P4': 'T'}))
+    scheduler.Prepare()
+    self.assertEqual(2, len(scheduler.model.Components()))
+    self.assertTrue(scheduler.AddGreedyStart())
+    self.assertEqual(2, len(scheduler.model.Components()))
+    self.assertEqual(2, len(scheduler.ComponentJobs(8)))
+
+
+class CancelRunTest(TestCase):
+
+  def testQueuedRunIsDone(self):
+    scheduler = MakeScheduler(MakeRows('M', {'P1': 'M'}))
+    solver_run = scheduler.solver_run
+    SolverRun.objects.filter(pk=solver_run.pk).update(state=SolverRun.IN_QUEUE)
+    self.client.post(reverse('solver:cancel_run', args=(solver_run.pk,)))
+    solver_run = SolverRun.objects.get(pk=solver_run.pk)
+    self.assertEqual(SolverRun.DONE, solver_run.state)
+    self.assertTrue(solver_run.cancel_requested)
 
-# Create your tests here.
+  def testWorkerSaveKeepsRequest(self):
+    scheduler = MakeScheduler(MakeRows('M', {'P1': 'M'}))
+    self.client.post(
+        reverse('solver:cancel_run', args=(scheduler.solver_run.pk,)))
+    # The worker's copy of the run doesn't know about the request yet.
+    scheduler.solver_run.save()
+    self.assertTrue(solver.CancelRequested(scheduler.solver_run))
@@ -7,6 +7,7 @@ urlpatterns = patterns('',
   url(r'^new_availability/', views.new_availability, name='new_availability'),
   url(r'^availability/(?P<availability_id>\d+)/$', views.availability, name='availability'),
   url(r'^run/(?P<pk>\d+)/$', views.SolverRunView.as_view(), name='run'),
+  url(r'^run/(?P<solver_run_id>\d+)/cancel/$', views.cancel_run, name='cancel_run'),
   url(r'^start/$', views.start_run, name='start_run'),
   url(r'^schedule/(?P<pk>\d+)/$', views.ScheduleView.as_view(), name='schedule'),
 )
@@ -11,6 +11,7 @@ from django.core.urlresolvers import reverse
 
 from solver.models import *
 from solver import solver
+from solver import wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +77,8 @@ def start_run(request):
 
   availability.csv_data = request.POST['csv_data']
   availability.default_length = request.POST['default_length']
+  if request.POST.get('parent_availability'):
+    availability.parent_id = int(request.POST['parent_availability'])
   availability.save()
 
   solver_options.arrive_late_bonus = request.POST['arrive_late_bonus']
@@ -96,6 +99,17 @@ def start_run(request):
   solver_run.state = SolverRun.IN_QUEUE
   solver_run.solution = SolverRun.NO_SOLUTION
   solver_run.save()
+  wakeup.NotifySolverWorkers()
 
   return HttpResponseRedirect(reverse('solver:run', args=(solver_run.id,)))
 
+def cancel_run(request, solver_run_id):
+  """Stop a run, keeping the best schedule it has found so far."""
+  if request.method == 'POST':
+    # A queued run is done right away, a running one is stopped by its
+    # worker.
+    SolverRun.objects.filter(pk=solver_run_id, state=SolverRun.IN_QUEUE).update(
+        state=SolverRun.DONE, cancel_requested=True)
+    SolverRun.objects.filter(pk=solver_run_id, state=SolverRun.RUNNING).update(
+        cancel_requested=True)
+  return HttpResponseRedirect(reverse('solver:run', args=(solver_run_id,)))
@@ -0,0 +1,88 @@
+# Copyright (c) 2014 Manfred Georg
+#
+# Author: Manfred Georg <manfred.georg@gmail.com>
+#
+# This file is part of session-scheduler.
+#
+# session-scheduler is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# session-scheduler is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with session-scheduler.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Wake up idle solve workers when a SolverRun is queued.
+
+The solve command binds a Unix datagram socket and its workers wait on
+it.  Anything that queues a run sends a datagram to it, which wakes one
+idle worker.  Workers still poll the database every
+kFallbackPollInterval seconds in case a notification is lost.
+"""
+
+import logging
+import os
+import select
+import socket
+
+from scheduler import settings
+
+logger = logging.getLogger(__name__)
+
+kFallbackPollInterval = 10.0
+
+
+def NotifySolverWorkers():
+  """Tell a waiting worker that there is something in the queue."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+  try:
+    sock.setblocking(False)
+    sock.sendto(b'q', settings.SOLVER_WAKEUP_SOCKET)
+  except OSError:
+    # No worker is listening (or the wakeup queue is already full), the
+    # workers will pick the run up when they next poll.
+    pass
+  finally:
+    sock.close()
+
+
+class Listener:
+  """The workers' end of the wakeup socket.
+
+  Create it before forking workers so that they all share the socket,
+  each datagram then wakes exactly one of them.
+  """
+
+  def __init__(self, path=None):
+    self.path = path or settings.SOLVER_WAKEUP_SOCKET
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sock.setblocking(False)
+    try:
+      if os.path.exists(self.path):
+        # Left behind by an earlier solve command.
+        os.unlink(self.path)
+      self.sock.bind(self.path)
+    except OSError:
+      logger.error('Unable to bind ' + self.path +
+                   ', falling back to polling the queue.')
+      self.sock.close()
+      self.sock = None
+
+  def Wait(self, timeout=kFallbackPollInterval):
+    """Wait until notified or until timeout seconds have passed."""
+    if not self.sock:
+      select.select([], [], [], timeout)
+      return
+    (ready, unused_write, unused_error) = select.select(
+        [self.sock], [], [], timeout)
+    if ready:
+      try:
+        self.sock.recv(16)
+      except BlockingIOError:
+        # Another worker got this notification.
+        pass